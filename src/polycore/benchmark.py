@@ -0,0 +1,194 @@
+"""
+Benchmark harness on synthetic (poly)ploid datasets.
+
+    python -m polycore.benchmark --scales 20x100000 100x1000000 --ploidy 2 --out benchmark.json
+
+Each scale (samples x length) gets a generated reference and sample FASTAs, then every public
+pipeline function is timed in pipeline order (best of --repeat). Results are saved as JSON
+together with the polycore version, git commit and environment, so runs can be compared
+between commits.
+"""
+from typing import List, Tuple, Dict, Optional
+import numpy as np, logging, os, time, json, gzip, tempfile, platform, subprocess, argparse
+from .utils import IUPAC_BITS, POPCOUNT16, decode_bases
+from .io_ops import (load_sequences, write_distances, write_fasta_from_array, write_vcf_from_array,
+                     write_summary)
+from .collapse import collapse_sequences, expand_results, expand_distances
+from .distance import set_ploidy, create_stack, to_bits, calculate_distances
+from .core_mask import filter_sequences, find_core, find_const, count_calls
+from .profiling import peak_rss, MB
+
+DNA = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+def ambiguity_codes(ploidy: int) -> np.ndarray:
+    """IUPAC codes a sample of this ploidy can carry (2..ploidy alleles)."""
+    codes = [ch for ch, bits in IUPAC_BITS.items() if 2 <= POPCOUNT16[bits] <= ploidy]
+    return np.frombuffer(''.join(codes).encode(), dtype=np.uint8)
+
+def write_fasta_record(path: str, name: str, seq: np.ndarray, compress: bool, width: int = 60) -> None:
+    body = seq.tobytes()
+    lines = b"\n".join(body[i:i + width] for i in range(0, len(body), width))
+    with (gzip.open(path, 'wb', compresslevel=1) if compress else open(path, 'wb')) as f:
+        f.write(b">" + name.encode() + b"\n" + lines + b"\n")
+
+def generate_dataset(directory: str, n_samples: int = 20, length: int = 100_000, ploidy: int = 2,
+                     snp_rate: float = 0.01, ambiguity_rate: float = 0.002, n_runs: int = 3,
+                     run_length: int = 500, duplicate_rate: float = 0.1, gap_rate: float = 0.0005,
+                     clades: int = 4, gzip_fraction: float = 0.5, seed: int = 1) -> List[str]:
+    """
+    Write a random reference and `n_samples` samples into `directory`; returns [ref] + samples.
+
+    Samples descend from `clades` clade sequences (half of `snp_rate` each step), carry
+    heterozygous IUPAC codes allowed by `ploidy` at `ambiguity_rate`, `n_runs` N-runs of
+    geometric length (mean `run_length`) and '-' gaps at `gap_rate`. With `duplicate_rate`
+    a sample is an exact copy of an earlier one. A `gzip_fraction` of the files is gzipped.
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    codes = ambiguity_codes(ploidy)
+
+    def mutate(seq: np.ndarray, rate: float) -> np.ndarray:
+        seq = seq.copy()
+        sites = np.flatnonzero(rng.random(length) < rate)
+        seq[sites] = DNA[rng.integers(0, 4, len(sites))]
+        return seq
+
+    ref = DNA[rng.integers(0, 4, length)]
+    files = [os.path.join(directory, 'ref.fa')]
+    write_fasta_record(files[0], 'ref', ref, compress=False)
+    clade_seqs = [mutate(ref, snp_rate / 2) for _ in range(clades)]
+    samples = []
+    for i in range(n_samples):
+        if samples and rng.random() < duplicate_rate:
+            seq = samples[rng.integers(len(samples))]
+        else:
+            seq = mutate(clade_seqs[rng.integers(clades)], snp_rate / 2)
+            if len(codes):
+                sites = np.flatnonzero(rng.random(length) < ambiguity_rate)
+                seq[sites] = codes[rng.integers(0, len(codes), len(sites))]
+            for start, size in zip(rng.integers(0, length, n_runs), rng.geometric(1 / run_length, n_runs)):
+                seq[start:start + size] = ord('N')
+            seq[rng.random(length) < gap_rate] = ord('-')
+        samples.append(seq)
+        compress = rng.random() < gzip_fraction
+        path = os.path.join(directory, f"sample{i:05d}.fa" + (".gz" if compress else ""))
+        write_fasta_record(path, f"sample{i:05d}", seq, compress)
+        files.append(path)
+    return files
+
+def _timed(timings: Dict[str, float], name: str, repeat: int, func, setup=None):
+    """Best-of-`repeat` wall time of func(*setup()); `setup` runs untimed (fresh input for in-place functions)."""
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        t = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - t)
+    timings[name] = best
+    return result
+
+def run_benchmarks(files: List[str], workdir: str, repeat: int = 1, threads: int = 1, ploidy: Optional[int] = None,
+                   min_gf: float = 0.5, min_cf: float = 0.9) -> Dict[str, float]:
+    """
+    Time the public pipeline functions on `files`, writing outputs into `workdir`.
+    Ploidy is detected (and `set_ploidy` timed) unless given.
+    """
+    timings: Dict[str, float] = {}
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        sequences, names, digests = _timed(timings, 'load_sequences', repeat,
+                                           lambda: load_sequences(files, threads=threads))
+        seqs, names_rep, idx_map = _timed(timings, 'collapse_sequences', repeat, collapse_sequences,
+                                          lambda: (sequences.copy(), names, digests))
+        ploidy, bit_map, lut = _timed(timings, 'set_ploidy', repeat, set_ploidy,
+                                      lambda: (seqs, IUPAC_BITS, ploidy))
+        stack = _timed(timings, 'create_stack', repeat, create_stack, lambda: (seqs.copy(), bit_map))
+        stack_valid, gf, keep = _timed(timings, 'filter_sequences', repeat, filter_sequences,
+                                       lambda: (stack, np.array(names_rep), min_gf))
+        stack_filt, names_filt = stack_valid[keep], np.array(names_rep)[keep]
+        _timed(timings, 'find_core', repeat, find_core,
+               lambda: (stack_filt, names_filt, gf[keep], min_cf, False, None))
+        core, names_core, cfs, _ = _timed(timings, 'find_core_progressive', repeat, find_core,
+                                          lambda: (stack_filt, names_filt, gf[keep], min_cf, True, None))
+        vars, _ = _timed(timings, 'find_const', repeat, find_const, lambda: (core, names_core, ploidy, 0, 0))
+        _timed(timings, 'count_calls', repeat, count_calls, lambda: (stack,))
+        _timed(timings, 'to_bits', repeat, to_bits, lambda: (decode_bases(vars), lut))
+        diffs = _timed(timings, 'calculate_distances', repeat, calculate_distances,
+                       lambda: (vars, ploidy, max(1, vars.shape[1]), threads))
+        no_mask = np.ones(len(names_rep), dtype=bool)
+        stack_exp, names_exp = _timed(timings, 'expand_results', repeat, expand_results,
+                                      lambda: (stack_valid, no_mask, idx_map, names))
+        diffs_exp, names_core_exp = _timed(timings, 'expand_distances', repeat, expand_distances,
+                                           lambda: (diffs, keep, idx_map, names))
+        _timed(timings, 'write_distances', repeat, write_distances, lambda: (names_core_exp, diffs_exp))
+        _timed(timings, 'write_fasta_from_array', repeat, write_fasta_from_array,
+               lambda: (core, list(names_core), 'core.full.aln'))
+        _timed(timings, 'write_vcf_from_array', repeat, write_vcf_from_array,
+               lambda: (vars, list(names_core), 'core.vcf'))
+        gf_exp, _ = expand_results(gf, no_mask, idx_map, names)
+        cfs_exp, _ = expand_results(np.array(cfs), keep, idx_map, names)
+        diffs0_exp, _ = expand_results(diffs.row(0), keep, idx_map, names)
+        _timed(timings, 'write_summary', repeat, write_summary,
+               lambda: (names_exp, stack_exp, gf_exp, cfs_exp, diffs0_exp))
+    finally:
+        os.chdir(cwd)
+    return timings
+
+def environment() -> dict:
+    from .cli import __version__
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(__file__)).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'polycore': __version__, 'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def parse_scale(text: str) -> Tuple[int, int]:
+    n_samples, length = text.lower().split('x')
+    return int(n_samples), int(float(length))
+
+def build_parser():
+    p = argparse.ArgumentParser(description="PolyCore benchmarks on synthetic datasets")
+    p.add_argument("--scales", nargs="+", type=parse_scale, default=[(10, 50_000), (50, 200_000), (200, 1_000_000)],
+                   metavar="NxL", help="Samples x alignment length, e.g. 100x1e6")
+    p.add_argument("--ploidy", type=int, default=2)
+    p.add_argument("--snp-rate", type=float, default=0.01)
+    p.add_argument("--ambiguity-rate", type=float, default=0.002)
+    p.add_argument("--n-runs", type=int, default=3, help="N-runs per sample")
+    p.add_argument("--run-length", type=int, default=500, help="Mean N-run length")
+    p.add_argument("--duplicate-rate", type=float, default=0.1)
+    p.add_argument("--repeat", type=int, default=1, help="Report the best of this many runs per function")
+    p.add_argument("--threads", type=int, default=1)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--data-dir", help="Keep generated datasets here (default: temporary)")
+    p.add_argument("--out", default="benchmark.json")
+    return p
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(message)s', datefmt='%H:%M:%S')
+    results = {**environment(), 'runs': []}
+    with tempfile.TemporaryDirectory(prefix='polycore-bench-') as tmp:
+        for n_samples, length in args.scales:
+            scale = {'n_samples': n_samples, 'length': length, 'ploidy': args.ploidy, 'snp_rate': args.snp_rate,
+                     'ambiguity_rate': args.ambiguity_rate, 'n_runs': args.n_runs, 'run_length': args.run_length,
+                     'duplicate_rate': args.duplicate_rate, 'seed': args.seed}
+            data = os.path.join(args.data_dir or tmp, f"{n_samples}x{length}")
+            t = time.perf_counter()
+            files = generate_dataset(data, n_samples, length, args.ploidy, args.snp_rate, args.ambiguity_rate,
+                                     args.n_runs, args.run_length, args.duplicate_rate, seed=args.seed)
+            print(f"{n_samples} x {length:,}: generated in {time.perf_counter() - t:.1f} s", flush=True)
+            workdir = tempfile.mkdtemp(dir=tmp)
+            timings = run_benchmarks(files, workdir, args.repeat, args.threads)
+            for name, seconds in timings.items():
+                print(f"  {name:<24}{seconds:>10.3f} s")
+            results['runs'].append({'scale': scale, 'timings': timings, 'peak_rss_mb': peak_rss() / MB})
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved -> {args.out}")
+
+if __name__ == "__main__":
+    main()
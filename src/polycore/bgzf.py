@@ -0,0 +1,123 @@
+"""
+BGZF (blocked gzip) output and tabix/CSI indexes for --vcf-compress, using zlib only.
+
+A BGZF file is a series of gzip members holding at most 64 KiB each, with the member size
+stored in a 'BC' extra field, followed by an empty EOF member. Any gzip reader can read it,
+and a virtual offset (block file offset << 16 | offset inside the block) addresses every
+record, which is what the .tbi/.csi indexes store.
+
+Input is cut into fixed BLOCK_SIZE slices, so an uncompressed offset maps to its block by
+division and only the compressed block offsets need to be kept.
+"""
+from typing import List, Tuple, Dict, Optional, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import numpy as np, struct, zlib
+
+BLOCK_SIZE = 0xff00   # uncompressed bytes per block, as in htslib
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+MIN_SHIFT = 14
+
+def compress_block(data, level: int = 6) -> bytes:
+    """One BGZF member holding `data` (at most BLOCK_SIZE bytes)."""
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    payload = c.compress(data) + c.flush()
+    if len(payload) + 26 > 1 << 16:
+        # incompressible data: stored deflate blocks always fit
+        c = zlib.compressobj(0, zlib.DEFLATED, -15)
+        payload = c.compress(data) + c.flush()
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(payload) + 25)
+    return header + payload + struct.pack('<II', zlib.crc32(data), len(data))
+
+def write_bgzf(filename: str, chunks: Iterable[bytes], threads: int = 1, level: int = 6) -> np.ndarray:
+    """
+    Write `chunks` as a BGZF file, compressing batches of blocks on a thread pool (zlib
+    releases the GIL). Returns the file offset of every block, the EOF block last.
+    """
+    offsets = [0]
+    pending = bytearray()
+    batch = max(1, threads) * 16
+    with open(filename, 'wb') as f, ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        def flush(data: bytes) -> None:
+            view = memoryview(data)
+            blocks = [view[i:i + BLOCK_SIZE] for i in range(0, len(view), BLOCK_SIZE)]
+            for block in pool.map(partial(compress_block, level=level), blocks):
+                f.write(block)
+                offsets.append(offsets[-1] + len(block))
+
+        for chunk in chunks:
+            pending += chunk
+            n_full = len(pending) // BLOCK_SIZE
+            if n_full >= batch:
+                flush(bytes(pending[:n_full * BLOCK_SIZE]))
+                del pending[:n_full * BLOCK_SIZE]
+        flush(bytes(pending))
+        f.write(EOF_BLOCK)
+    return np.array(offsets, dtype=np.uint64)
+
+def virtual_offsets(block_offsets: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """Virtual offsets of uncompressed byte `positions` in a file written by `write_bgzf`."""
+    positions = np.asarray(positions, dtype=np.uint64)
+    return (block_offsets[positions // BLOCK_SIZE] << np.uint64(16)) | (positions % BLOCK_SIZE)
+
+def _depth(length: int) -> int:
+    depth = 5
+    while length > 1 << (MIN_SHIFT + 3 * depth):
+        depth += 1
+    return depth
+
+def _run_starts(values: np.ndarray) -> np.ndarray:
+    """Indices where a run of equal values starts."""
+    return np.flatnonzero(np.r_[len(values) > 0, values[1:] != values[:-1]])
+
+def write_index(filename: str, kind: str, contig: str, begs: np.ndarray,
+                starts: np.ndarray, ends: np.ndarray) -> None:
+    """
+    Write a tabix ('tbi') or CSI ('csi') index for one contig of 1-bp VCF records.
+
+    begs         : 0-based record positions, sorted
+    starts, ends : virtual offsets of the start and end of each record
+    """
+    depth = 5 if kind == 'tbi' else _depth(int(begs[-1]) + 1 if len(begs) else 1)
+    first_leaf = ((1 << 3 * depth) - 1) // 7
+    pseudo_bin = ((1 << 3 * (depth + 1)) - 1) // 7 + 1
+
+    # every record lies in a single leaf bin; sorted records give one chunk per bin
+    bins = first_leaf + (begs >> MIN_SHIFT)
+    first = _run_starts(bins)
+    last = np.r_[first[1:], len(bins)] - 1
+
+    ref = bytearray()
+    ref += struct.pack('<i', len(first) + (len(begs) > 0))
+    for a, b in zip(first, last):
+        if kind == 'tbi':
+            ref += struct.pack('<IiQQ', int(bins[a]), 1, int(starts[a]), int(ends[b]))
+        else:
+            ref += struct.pack('<IQiQQ', int(bins[a]), int(starts[a]), 1, int(starts[a]), int(ends[b]))
+    if len(begs):
+        # htslib's per-contig metadata: file span and mapped/unmapped record counts
+        meta = (int(starts[0]), int(ends[-1]), len(begs), 0)
+        if kind == 'tbi':
+            ref += struct.pack('<Ii4Q', pseudo_bin, 2, *meta)
+        else:
+            ref += struct.pack('<IQi4Q', pseudo_bin, 0, 2, *meta)
+    if kind == 'tbi':
+        # linear index: first record of every 16 kb window, carried forward over empty ones
+        windows = begs >> MIN_SHIFT
+        n_windows = int(windows[-1]) + 1 if len(begs) else 0
+        ioff = np.zeros(n_windows, dtype=np.uint64)
+        w_first = _run_starts(windows)
+        ioff[windows[w_first]] = starts[w_first]
+        for w in range(1, n_windows):
+            if ioff[w] == 0:
+                ioff[w] = ioff[w - 1]
+        ref += struct.pack('<i', n_windows) + ioff.astype('<u8').tobytes()
+
+    names = contig.encode() + b'\0'
+    # tabix configuration for VCF: format, seq/begin/end columns, meta char, skipped lines
+    conf = struct.pack('<7i', 2, 1, 2, 0, ord('#'), 0, len(names)) + names
+    if kind == 'tbi':
+        data = b'TBI\1' + struct.pack('<i', 1) + conf + ref
+    else:
+        data = b'CSI\1' + struct.pack('<3i', MIN_SHIFT, depth, len(conf)) + conf + struct.pack('<i', 1) + ref
+    write_bgzf(f"{filename}.{kind}", [data + struct.pack('<Q', 0)])
@@ -1,9 +1,13 @@
 import sys, time, argparse, logging, numpy as np
-from .utils import set_up_logging, IUPAC_BITS, auto_chunk_size
-from .io_ops import load_sequences, write_distances, write_fasta_from_array, write_vcf_from_array, write_summary
-from .collapse import collapse_sequences, expand_results, expand_distances, expand_vector
-from .distance import set_ploidy, create_stack, to_bits, calculate_distances
-from .core_mask import filter_sequences, find_core, find_const
+from .utils import set_up_logging, IUPAC_BITS
+from .io_ops import DIST_FORMATS, load_sequences, read_distance_cache, write_distance_cache, write_distances, write_fasta_from_array, write_vcf_from_array, write_summary_counts
+from .collapse import (collapse_sequences, collapse_near_duplicates, expand_results, expand_distances, expand_vector,
+                       expansion_index, per_sample, ExpandedView)
+from .distance import set_ploidy, create_stack, auto_chunk_size, calculate_distances, update_distances
+from .core_mask import count_calls, flag_low_gf, filter_counts, core_from_counts, const_from_counts, take_sites
+from .stream import run_stream
+from .plot import PLOT_BACKENDS
+from .profiling import StageReport
 from typing import List, Tuple, Dict, Optional
 
 
@@ -18,72 +22,158 @@ def build_parser():
     p.add_argument("--min-pf", type=float, default=0, help="Min fraction with alt per site (SNP vs SNV)")
     p.add_argument("--min-pn", type=float, default=0, help="Min # samples with alt per site (SNP vs SNV)")
     p.add_argument("--progressive", action='store_true')
+    p.add_argument("--plot", choices=PLOT_BACKENDS, default='svg',
+                   help="Backend of the progressive core plot: inline SVG (no dependencies) or plotly (bundled or CDN plotly.js)")
+    p.add_argument("--no-plot", action='store_true', help="Do not write core_fraction_plot.html")
     p.add_argument("--ploidy", type=int)
+    p.add_argument("--collapse-n", action='store_true',
+                   help="Also collapse samples that differ only where one of them is N (not with --stream)")
     p.add_argument("--chunk-size", type=int, help="Sites per chunk for pairwise diffs (controls memory)")
+    p.add_argument("--stream", action='store_true',
+                   help="Process the alignment from disk in column windows (bounded memory)")
+    p.add_argument("--window-size", type=int, default=100_000, help="Sites per window with --stream")
+    p.add_argument("--store", help="Directory of a persistent alignment store reused across runs (not used with --stream)")
+    p.add_argument("--dist-cache",
+                   help="Distance cache (.npz): reuse pairs of unchanged samples and update it in place")
+    p.add_argument("--threads", type=int, default=1, help="Worker processes for loading FASTAs and threads for pairwise diffs and VCF compression")
+    p.add_argument("--dist-format", nargs="+", choices=DIST_FORMATS, default=['wide', 'long'],
+                   help="Distance outputs: wide/long CSV and/or binary npy (full matrix) / triu (packed upper triangle)")
+    p.add_argument("--vcf-compress", action='store_true', help="Write core.vcf.gz as BGZF (bgzip-compatible)")
+    p.add_argument("--vcf-index", choices=['tbi', 'csi'], help="Also write a tabix (.tbi) or CSI (.csi) index (with --vcf-compress)")
+    p.add_argument("--timings", nargs="?", const="timings.json",
+                   help="Save the per-stage time/memory report as JSON (default file: timings.json)")
     p.add_argument("--version", action="version", version=__version__)
     return p
 
+def finish(report: StageReport, args) -> None:
+    """Log the per-stage report and save it with --timings."""
+    report.log_table()
+    if args.timings:
+        report.write_json(args.timings, version=__version__, options=vars(args))
+
 def main(argv=None):
     argv = argv or sys.argv[1:]
     set_up_logging()
     logger = logging.getLogger(__name__)
     parser = build_parser()
     args = parser.parse_args(argv)
+    if args.stream and args.collapse_n:
+        parser.error("--collapse-n is not supported with --stream")
+    if args.vcf_index and not args.vcf_compress:
+        parser.error("--vcf-index requires --vcf-compress")
 
     start = time.time()
     logger.info(f"PolyCore v{__version__} starting")
 
     try:
         files = [args.ref] + args.sample
-        sequences, orig_names = load_sequences(files)
+        report = StageReport()
+        if args.stream:
+            run_stream(args, files, report)
+            finish(report, args)
+            logger.info(f"Done in {time.time()-start:.1f}s")
+            return
+
+        with report.stage('load') as arrays:
+            sequences, orig_names, digests = load_sequences(files, threads=args.threads, store=args.store)
+            arrays['sequences'] = sequences
 
         # Collapse → bitmaps → stack
-        sequences, names_rep, idx_map = collapse_sequences(sequences, orig_names)
-        ploidy, bit_map, bit_lut = set_ploidy(sequences, IUPAC_BITS, args.ploidy)
-        stack, valid_bases = create_stack(sequences, bit_map)
-
-        # Filtering
-        stack_valid, gf, filter_mask = filter_sequences(
-            stack, np.array(names_rep), valid_bases, args.min_gf
-        )
-        stack_filt  = stack_valid[filter_mask, :]
-        names_filt  = np.array(names_rep)[filter_mask]
-        gf_filt     = gf[filter_mask]
+        with report.stage('collapse') as arrays:
+            sequences, names_rep, idx_map = collapse_sequences(sequences, orig_names, digests)
+            arrays['sequences'] = sequences
+        with report.stage('stack') as arrays:
+            ploidy, bit_map, _ = set_ploidy(sequences, IUPAC_BITS, args.ploidy)
+            stack = create_stack(sequences, bit_map)
+            del sequences
+            sample_gf = sample_missing = None
+            if args.collapse_n:
+                # judge every sample on its own calls: N-tolerant clusters fill gaps from other members
+                own = count_calls(stack)
+                n_valid = int(np.count_nonzero(own['valid']))
+                own_gf = own['called'] / n_valid
+                sample_gf = per_sample(own_gf, idx_map, len(orig_names))
+                sample_missing = per_sample(n_valid - own['called'], idx_map, len(orig_names))
+                passing = flag_low_gf(own_gf, np.array(names_rep), args.min_gf)
+                del own
+                stack, names_rep, idx_map = collapse_near_duplicates(stack, names_rep, idx_map, keep=passing)
+            arrays['stack'] = stack
+
+        # Filtering, core and constant sites from per-sample/per-site counters (one pass over the stack)
+        with report.stage('filter') as arrays:
+            counts = count_calls(stack)
+            gf, filter_mask = filter_counts(counts, stack, np.array(names_rep), args.min_gf)
+            names_filt  = np.array(names_rep)[filter_mask]
+            n_valid = int(np.count_nonzero(counts['valid']))
+            if sample_gf is None:
+                sample_gf = per_sample(gf, idx_map, len(orig_names))
+                sample_missing = per_sample(n_valid - counts['called'], idx_map, len(orig_names))
+            arrays.update(calls=counts['calls'], matches=counts['matches'])
 
         # Core only on kept reps
-        core, names_core, cfs = find_core(
-            stack_filt, names_filt, gf_filt,
-            threshold=args.min_cf, progressive=args.progressive
-        )
+        with report.stage('core') as arrays:
+            core_mask, cfs = core_from_counts(
+                counts, stack, names_rep, gf, filter_mask,
+                threshold=args.min_cf, progressive=args.progressive,
+                plot=None if args.no_plot else args.plot
+            )
+            kept_rows = np.flatnonzero(filter_mask)
+            core = take_sites(stack, kept_rows, core_mask)
+            names_core = names_filt
+            arrays['core'] = core
 
         # Vars on core set
-        vars = find_const(core, names_core, ploidy, args.min_pf, args.min_pn)
-
-        # Distances on core variants
-        bits = to_bits(vars, bit_lut)
-        chunk_size = args.chunk_size or auto_chunk_size(bits.shape[0])
-        diffs = calculate_distances(bits, ploidy, chunk_size)
+        with report.stage('const') as arrays:
+            var_sites = const_from_counts(counts, stack, core_mask, ploidy, args.min_pf, args.min_pn)
+            sites = np.flatnonzero(var_sites)  # alignment positions of the variant columns
+            vars = take_sites(stack, kept_rows, var_sites)
+            del stack, counts
+            arrays['vars'] = vars
+
+        # Distances on core variants (the stack is already bit-encoded)
+        with report.stage('distances') as arrays:
+            bits = vars
+            if args.chunk_size:
+                chunk_size, block_size, threads = args.chunk_size, 256, args.threads
+            else:
+                chunk_size, block_size, threads = auto_chunk_size(bits.shape[0], bits.shape[1], ploidy, args.threads)
+            if args.dist_cache:
+                diffs = update_distances(bits, list(names_core), sites, ploidy, chunk_size,
+                                         read_distance_cache(args.dist_cache), threads=threads,
+                                         block_size=block_size)
+                write_distance_cache(args.dist_cache, list(names_core), sites, bits, diffs, ploidy)
+            else:
+                diffs = calculate_distances(bits, ploidy, chunk_size, threads=threads, block_size=block_size)
+            arrays['diffs'] = diffs.data
 
         # ---------------- Expansion strategy ----------------
-        no_mask = np.full(stack_valid.shape[0], True, dtype=bool)
-        stack_exp, names_exp = expand_results(stack_valid, no_mask, idx_map, orig_names)
-        gf_exp, _ = expand_results(np.array(gf),  no_mask, idx_map,  orig_names)
-        cfs_exp, _ = expand_results(np.array(cfs), filter_mask, idx_map, orig_names)
-        core_exp, names_core_exp = expand_results(core, filter_mask, idx_map, orig_names, keep_filtered=False)
-        vars_exp, _ = expand_results(vars, filter_mask, idx_map, orig_names, keep_filtered=False)
-        diffs0_exp, _ = expand_results(diffs[0,:], filter_mask, idx_map, orig_names)
-        diffs_exp, diffs_exp_names  = expand_distances(diffs, filter_mask, idx_map, orig_names)
+        with report.stage('expand'):
+            no_mask = np.full(len(names_rep), True, dtype=bool)
+            # per-sample genome fraction and missing calls come from each sample's own row
+            _, orig_exp = expansion_index(no_mask, idx_map)
+            names_exp = [orig_names[i] for i in orig_exp]
+            gf_exp, missing_exp = sample_gf[orig_exp], sample_missing[orig_exp]
+            cfs_exp, _ = expand_results(np.array(cfs), filter_mask, idx_map, orig_names)
+            # alignments are viewed in original order and gathered row by row by the writers
+            core_exp = ExpandedView(core, filter_mask, idx_map, keep_filtered=False)
+            vars_exp = ExpandedView(vars, filter_mask, idx_map, keep_filtered=False)
+            names_core_exp = core_exp.names(orig_names)
+            diffs0_exp, _ = expand_results(diffs.row(0), filter_mask, idx_map, orig_names)
+            diffs_exp, diffs_exp_names  = expand_distances(diffs, filter_mask, idx_map, orig_names)
 
         # ---------------- Write outputs ----------------
-        # Distances/FASTA/VCF: only core set (no filtered samples)
-        write_distances(diffs_exp_names, diffs_exp)
-        write_fasta_from_array(core_exp, names_core_exp, "core.full.aln")
-        write_fasta_from_array(vars_exp, names_core_exp, "core.aln")
-        write_vcf_from_array(vars_exp, names_core_exp, "core.vcf")
-
-        # Summary: all originals
-        write_summary(names_exp, stack_exp, gf_exp, cfs_exp, diffs0_exp)
-
+        with report.stage('write'):
+            # Distances/FASTA/VCF: only core set (no filtered samples)
+            write_distances(diffs_exp_names, diffs_exp, args.dist_format)
+            write_fasta_from_array(core_exp, names_core_exp, "core.full.aln")
+            write_fasta_from_array(vars_exp, names_core_exp, "core.aln")
+            write_vcf_from_array(vars_exp, names_core_exp, "core.vcf.gz" if args.vcf_compress else "core.vcf",
+                                 compress=args.vcf_compress, index=args.vcf_index, threads=args.threads)
+
+            # Summary: all originals
+            write_summary_counts(names_exp, n_valid, missing_exp, gf_exp, cfs_exp, diffs0_exp)
+
+        finish(report, args)
         logger.info(f"Done in {time.time()-start:.1f}s")
 
     except Exception:
@@ -1,36 +1,32 @@
-from typing import List, Tuple, Dict, Optional
-import numpy as np, logging
+from typing import Iterable, List, Tuple, Dict, Optional
+import numpy as np, logging, hashlib
+from itertools import chain
+from .distance import CondensedMatrix
 
-def collapse_sequences(sequences: List[str], names: List[str]) -> Tuple[List[str], List[str], Dict[int, List[int]]]:
+def group_identical(keys: Iterable, names: List[str]) -> Tuple[List[int], List[str], Dict[int, List[int]]]:
     """
-    Collapse identical sequences.
+    Group samples whose keys are equal, in first-occurrence order (the reference is always rep 0).
 
     Returns:
-        unique_sequences : list of unique sequence strings
-        rep_names        : representative names
-        idx_map          : dict {rep_idx -> [orig_indices]} mapping reps to their group
+        rep_rows  : original index of each group's representative (first occurrence)
+        rep_names : representative names
+        idx_map   : dict {rep_idx -> [orig_indices]} mapping reps to their group
     """
     logger = logging.getLogger(__name__)
 
     seen = {}
     idx_map: Dict[int, List[int]] = {}
-    unique_sequences = []
+    rep_rows = []
     rep_names = []
 
-    # always keep the reference (index 0)
-    unique_sequences.append(sequences[0])
-    rep_names.append(names[0])
-    seen[sequences[0]] = 0
-    idx_map[0] = [0]
-
-    for i, (seq, name) in enumerate(zip(sequences[1:], names[1:]), start=1):
-        if seq in seen:
-            rep_idx = seen[seq]
+    for i, (key, name) in enumerate(zip(keys, names)):
+        if key in seen:
+            rep_idx = seen[key]
             idx_map[rep_idx].append(i)
         else:
-            rep_idx = len(unique_sequences)
-            seen[seq] = rep_idx
-            unique_sequences.append(seq)
+            rep_idx = len(rep_rows)
+            seen[key] = rep_idx
+            rep_rows.append(i)
             rep_names.append(name)
             idx_map[rep_idx] = [i]
 
@@ -40,75 +36,207 @@ def collapse_sequences(sequences: List[str], names: List[str]) -> Tuple[List[str
         if len(group_names) > 1:
             logger.info(f"Identical samples will be treated as one: {group_names} -> ")
 
-    return unique_sequences, rep_names, idx_map
+    return rep_rows, rep_names, idx_map
 
-def expand_results(filtered_array: np.ndarray, filter_mask: np.ndarray, idx_map: Dict[int, List[int]], orig_names: List[str], keep_filtered: bool = True):
+def collapse_sequences(sequences: np.ndarray, names: List[str],
+                       digests: Optional[List[str]] = None) -> Tuple[np.ndarray, List[str], Dict[int, List[int]]]:
     """
-    Expand filtered results back to original sample space.
-    Works for both 1D and 2D arrays.
+    Collapse identical sequences.
+
+    Rows are grouped by content digest (as returned by `load_sequences`, or computed here);
+    rows with equal digests are byte-compared before being merged, so a hash collision can
+    never join two different genomes. Unique rows are compacted to the front of `sequences`
+    in place, so no second copy of the matrix is made.
+
+    Returns:
+        unique_sequences : (n_unique, L) view of the unique rows
+        rep_names        : representative names
+        idx_map          : dict {rep_idx -> [orig_indices]} mapping reps to their group
     """
-    fi = 0  # Index into filtered_array
-    expanded_rows = []
-    expanded_names = []
-    
-    for mi, oi in idx_map.items():
-        if filter_mask[mi]:
-            val = filtered_array[fi]
-            fi += 1
+    if digests is None:
+        digests = [hashlib.blake2b(row).hexdigest() for row in sequences]
+
+    # (digest, k): k tells apart genuinely different rows that share a digest
+    keys = []
+    first_rows: Dict[str, List[int]] = {}
+    for i, digest in enumerate(digests):
+        candidates = first_rows.setdefault(digest, [])
+        for k, j in enumerate(candidates):
+            if np.array_equal(sequences[i], sequences[j]):
+                keys.append((digest, k))
+                break
         else:
-            if not keep_filtered:
-                continue
-            # Create appropriate null value based on array dimensions
-            if filtered_array.ndim == 1:
-                val = np.nan
-            else:
-                # For 2D, create a row of NaNs with same width as filtered_array
-                val = np.full(filtered_array.shape[1], np.nan)
-        
-        # Expand to all original samples in this group
-        for i in oi:
-            expanded_rows.append(val)
-            expanded_names.append(orig_names[i])
-    
-    return np.array(expanded_rows), expanded_names
-
-def expand_distances(diffs, filter_mask, idx_map, orig_names):
+            keys.append((digest, len(candidates)))
+            candidates.append(i)
+
+    rep_rows, rep_names, idx_map = group_identical(keys, names)
+    for rep_idx, i in enumerate(rep_rows):
+        if rep_idx != i:
+            sequences[rep_idx] = sequences[i]
+    return sequences[:len(rep_rows)], rep_names, idx_map
+
+def collapse_near_duplicates(stack: np.ndarray, names: List[str], idx_map: Dict[int, List[int]],
+                             chunk_size: int = 1 << 16, keep: Optional[np.ndarray] = None
+                             ) -> Tuple[np.ndarray, List[str], Dict[int, List[int]]]:
     """
-    Expand a rep-level distance matrix to original samples,
-    but only for reps where filter_mask is True.
+    Merge reps whose calls agree at every valid site where both are non-N.
+
+    `stack` is the nibble stack of the reps (0 = N); the reference (row 0) is never merged.
+    Reps outside `keep` (e.g. below --min-gf) stay single clusters with their own row, so
+    mostly-N samples are not absorbed into a consensus they would then be judged on.
+    Reps are visited from most to least complete and joined to the first compatible cluster,
+    whose consensus row then takes the new calls wherever it was still N. Because every member
+    agrees with the consensus, members also agree pairwise. Rows are merged in place and the
+    consensus rows are compacted to the front, ordered by each cluster's first rep.
+
+    Returns:
+        stack     : (n_clusters, L) view of the consensus rows
+        rep_names : name of each cluster's first rep
+        idx_map   : dict {cluster_idx -> [orig_indices]} covering all members
     """
-    # 1) Ordered kept reps by rep index so fi/fj match rows/cols in `diffs`
-    kept_reps = [r for r, keep in enumerate(filter_mask) if keep]
+    logger = logging.getLogger(__name__)
+    n_rows, n_cols = stack.shape
+    valid = stack[0] != 0
+    called = np.count_nonzero(stack, axis=1)
+    order = sorted(range(1, n_rows), key=lambda r: -called[r])
+
+    seeds: List[int] = []
+    members: Dict[int, List[int]] = {0: [0]}
+    for r in order:
+        if keep is not None and not keep[r]:
+            members[r] = [r]
+            continue
+        candidates = np.array(seeds, dtype=int)
+        for start in range(0, n_cols, chunk_size):
+            if candidates.size == 0:
+                break
+            end = min(start + chunk_size, n_cols)
+            row = stack[r, start:end]
+            cons = stack[candidates, start:end]
+            conflict = (cons != row) & (cons != 0) & (row != 0) & valid[start:end]
+            candidates = candidates[~conflict.any(axis=1)]
+        if candidates.size:
+            seed = int(candidates[0])
+            np.copyto(stack[seed], stack[r], where=stack[seed] == 0)
+            members[seed].append(r)
+        else:
+            seeds.append(r)
+            members[r] = [r]
 
-    # 2) Build expanded name list once (length == total originals among kept reps)
-    expanded_names = [orig_names[i]
-                      for rep in kept_reps
-                      for i in idx_map[rep]]
+    clusters = sorted(members.values(), key=min)
+    new_map: Dict[int, List[int]] = {}
+    rep_names = []
+    for k, group in enumerate(clusters):
+        seed = group[0]
+        if seed != k:
+            # seed >= min(group) >= k, so no later cluster's seed row is overwritten
+            stack[k] = stack[seed]
+        new_map[k] = sorted(i for rep in group for i in idx_map[rep])
+        rep_names.append(names[min(group)])
+        if len(group) > 1:
+            logger.info(f"Samples differing only by N will be treated as one: "
+                        f"{[names[rep] for rep in sorted(group)]} -> ")
+    logger.info(f"Collapsed {n_rows} reps into {len(clusters)} N-tolerant clusters")
+    return stack[:len(clusters)], rep_names, new_map
+
+def expansion_index(filter_mask: np.ndarray, idx_map: Dict[int, List[int]],
+                    keep_filtered: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Gather indices that expand rep-level results to original samples (grouped by rep, in
+    idx_map order).
 
-    # 3) Allocate expanded distance matrix and fill by blocks
-    sizes = [len(idx_map[rep]) for rep in kept_reps]
-    n = sum(sizes)
-    expanded = np.empty((n, n), dtype=diffs.dtype)
+    Returns:
+        rows : row of the filtered array for each expanded sample (-1 for filtered-out reps)
+        orig : original sample index of each expanded sample
+    """
+    reps = np.fromiter(idx_map.keys(), dtype=np.intp, count=len(idx_map))
+    sizes = np.fromiter((len(group) for group in idx_map.values()), dtype=np.intp, count=len(idx_map))
+    orig = np.fromiter(chain.from_iterable(idx_map.values()), dtype=np.intp, count=int(sizes.sum()))
+    kept = np.asarray(filter_mask, dtype=bool)[reps]
+    rows = np.repeat(np.where(kept, np.cumsum(kept) - 1, -1), sizes)
+    if not keep_filtered:
+        rows, orig = rows[rows >= 0], orig[rows >= 0]
+    return rows, orig
+
+class ExpandedView:
+    """
+    A filtered rep-level array seen in original sample space without copying it: rows are
+    gathered on demand (one at a time when iterated, or a block for view[rows, cols]).
+    Filtered-out reps read as NaN rows unless keep_filtered is False.
+    """
 
-    r0 = 0
-    for a, rep_a in enumerate(kept_reps):
-        ga = idx_map[rep_a]        # original indices in this group
-        ra = len(ga)
-        c0 = 0
-        for b, rep_b in enumerate(kept_reps):
-            gb = idx_map[rep_b]
-            rb = len(gb)
-            expanded[r0:r0+ra, c0:c0+rb] = diffs[a, b]
-            c0 += rb
-        r0 += ra
+    def __init__(self, array: np.ndarray, filter_mask: np.ndarray, idx_map: Dict[int, List[int]],
+                 keep_filtered: bool = True):
+        self.array = np.asarray(array)
+        self.rows, self.orig = expansion_index(filter_mask, idx_map, keep_filtered)
+        self.dtype = (np.result_type(self.array.dtype, np.float64) if np.any(self.rows < 0)
+                      else self.array.dtype)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return (len(self.rows),) + self.array.shape[1:]
+
+    @property
+    def ndim(self) -> int:
+        return self.array.ndim
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self.rows)))
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        source = self.array[:, cols] if self.array.ndim > 1 else self.array
+        return _gather(source, self.rows[rows])
+
+    def names(self, orig_names: List[str]) -> List[str]:
+        return [orig_names[i] for i in self.orig]
+
+    def expand(self, values: np.ndarray) -> np.ndarray:
+        """Gather a per-row vector of `array` (e.g. a row reduction) into original sample space."""
+        return _gather(np.asarray(values), self.rows)
+
+def _gather(source: np.ndarray, rows) -> np.ndarray:
+    """source[rows], with NaN for rows of -1 (filtered-out reps)."""
+    missing = np.asarray(rows) < 0
+    if not missing.any():
+        return source[rows]
+    out = np.full(np.shape(rows) + source.shape[1:], np.nan, dtype=np.result_type(source.dtype, np.float64))
+    out[~missing] = source[np.asarray(rows)[~missing]]
+    return out
+
+def per_sample(values: np.ndarray, idx_map: Dict[int, List[int]], n_samples: int) -> np.ndarray:
+    """Rep-level values indexed by original sample."""
+    values = np.asarray(values)
+    rows, orig = expansion_index(np.ones(len(idx_map), dtype=bool), idx_map)
+    out = np.empty((n_samples,) + values.shape[1:], dtype=values.dtype)
+    out[orig] = values[rows]
+    return out
 
-    return expanded, expanded_names
+def expand_results(filtered_array: np.ndarray, filter_mask: np.ndarray, idx_map: Dict[int, List[int]], orig_names: List[str], keep_filtered: bool = True):
+    """
+    Expand filtered results back to original sample space.
+    Works for both 1D and 2D arrays; filtered-out reps become NaN rows unless keep_filtered is False.
+    """
+    view = ExpandedView(filtered_array, filter_mask, idx_map, keep_filtered)
+    return view[:], view.names(orig_names)
 
+def expand_distances(diffs, filter_mask, idx_map, orig_names):
+    """
+    Expand a rep-level distance matrix to original samples,
+    but only for reps where filter_mask is True.
 
+    A CondensedMatrix is returned as a lazy view (rows are gathered by the writers);
+    a square array is expanded with a single gather.
+    """
+    rows, orig = expansion_index(filter_mask, idx_map, keep_filtered=False)
+    expanded_names = [orig_names[i] for i in orig]
+    if isinstance(diffs, CondensedMatrix):
+        return diffs.take(rows), expanded_names
+    return np.asarray(diffs)[np.ix_(rows, rows)], expanded_names
 
 def expand_vector(vector: np.ndarray, names: List[str], idx_map: Dict[int, List[int]]):
-    expanded = []
-    for rep_idx, val in enumerate(vector):
-        for _ in idx_map[rep_idx]:
-            expanded.append(val)
-    return expanded
\ No newline at end of file
+    sizes = [len(idx_map[rep_idx]) for rep_idx in range(len(vector))]
+    return list(np.repeat(np.asarray(vector), sizes))
\ No newline at end of file
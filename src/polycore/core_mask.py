@@ -1,52 +1,68 @@
 import numpy as np, logging
 from typing import List, Tuple, Dict, Optional
-from collections import Counter
-from .io_ops import create_plot
+from .plot import create_plot
+from .utils import IUPAC_BITS
 
-def filter_sequences(stack, names, valid_bases, min_gf=0.9):
+def filter_sequences(stack, names, min_gf=0.9):
+    """
+    Drop invalid reference positions and flag samples below `min_gf`.
+    `stack` holds IUPAC nibble masks; invalid bases were already encoded as 0 (N) by `create_stack`.
+    """
     names = np.array(names)  # ensure numpy array
     # Filter invalid bases in reference
     ref = stack[0]
-    stack_valid = stack[:, np.isin(ref, valid_bases)]
+    stack_valid = stack[:, ref > 0]
     logging.info(f"Removed {stack.shape[1] - stack_valid.shape[1]} invalid reference positions")
-    # Mask invalid bases in all samples
-    stack_valid[~np.isin(stack_valid, valid_bases)] = 'N'
 
-    logging.info(f"Filtering {stack.shape[0]} sequences, min_gf={min_gf}")
     # Calculate genome fraction
-    gf = (np.sum(stack_valid != 'N', axis=1) / stack_valid.shape[1]).astype(float)
+    gf = (np.count_nonzero(stack_valid, axis=1) / stack_valid.shape[1]).astype(float)
+    keep = flag_low_gf(gf, names, min_gf)
+
+    return stack_valid, gf, keep
+
+def flag_low_gf(gf, names, min_gf):
+    """Boolean keep-mask of samples whose genome fraction reaches `min_gf`."""
+    names = np.array(names)
+    logging.info(f"Filtering {len(gf)} sequences, min_gf={min_gf}")
     keep = gf >= min_gf
 
     logging.info(f"Kept {np.sum(keep)}/{len(keep)} sequences")
     if np.any(~keep):
         logging.info(f"Sequences with genome fraction below {min_gf}: {names[~keep]}")
+    return keep
 
-    return stack_valid, gf, keep
-
-def find_core(stack, names, gf, threshold=1.0, progressive=True):
-    """Calculate progressive core genome fraction."""
+def find_core(stack, names, gf, threshold=1.0, progressive=True, plot='svg'):
+    """
+    Calculate progressive core genome fraction. Also returns the core site mask over `stack` columns.
+    `plot` is the backend of the progression plot, or None for no plot.
+    """
     n_rows, n_cols = stack.shape
     if not progressive:
         logging.info('Determining core (non-progressive)')
-        fractions = np.sum(stack != 'N', axis=0) / n_rows
+        fractions = np.count_nonzero(stack, axis=0) / n_rows
         core_mask = fractions >= threshold
         core_fraction = np.sum(core_mask) / n_cols
         logging.info(f"Sites below min-cf ({threshold}): {np.sum(~core_mask)}")
         logging.info(f"Final core fraction: {core_fraction:.2f}")
         stack_core = stack[:, core_mask]
-        return stack_core, names, [np.nan] * len(names)
+        return stack_core, names, [np.nan] * len(names), core_mask
 
     logging.info('Determing soft-core (progressive):')
     sort_indices = np.argsort(gf[1:])[::-1] + 1
-    sorted_stack = np.vstack([stack[0:1], stack[sort_indices]])
-    sorted_names = np.concatenate([names[0:1], names[sort_indices]])
+    order = np.concatenate(([0], sort_indices))
+    sorted_names = names[order]
 
+    # Running per-site count of non-N calls, updated one sample at a time (O(n * L) overall)
+    counts = np.zeros(n_cols, dtype=np.uint32)
+    fractions = np.empty(n_cols, dtype=float)
+    core_mask = np.empty(n_cols, dtype=bool)
     cfs = []                          # progression trajectory (sorted order)
     per_sample_cf = {}                # sample -> core fraction at its addition
-    for i in range(1, n_rows + 1):
-        fractions = np.sum(sorted_stack[0:i] != 'N', axis=0) / i
-        core_mask = fractions >= threshold
-        core_fraction = np.sum(core_mask) / n_cols
+    for i, row in enumerate(order, start=1):
+        counts += stack[row] != 0
+        np.divide(counts, i, out=fractions)
+        np.greater_equal(fractions, threshold, out=core_mask)
+        core_fraction = np.count_nonzero(core_mask) / n_cols
         cfs.append(core_fraction)
         sample_name = sorted_names[i-1]
         per_sample_cf[sample_name] = core_fraction
@@ -55,42 +71,63 @@ def find_core(stack, names, gf, threshold=1.0, progressive=True):
     logging.info(f"Sites below min-cf ({threshold}): {np.sum(~core_mask)}")
     logging.info(f"Final core fraction: {core_fraction:.2f}")
 
-    create_plot(cfs, sorted_names)
-
-    stack_core_sorted = sorted_stack[:, core_mask]
+    if plot:
+        create_plot(cfs, sorted_names, plot)
 
-    # re-sort rows back to the original input order
-    combined_idx = np.concatenate(([0], sort_indices))
-    pos_to_original = np.argsort(combined_idx)
-    stack_core_original = stack_core_sorted[pos_to_original, :]
+    # rows are still in the original input order; only the site mask came from the sorted pass
+    stack_core_original = stack[:, core_mask]
 
     # now produce cfs in the same order as names
     cfs_original = [per_sample_cf[n] for n in names]
 
-    return stack_core_original, names, cfs_original
+    return stack_core_original, names, cfs_original, core_mask
 
-def find_const(stack, names, ploidy, min_pf, min_pn):
-    logging.info("Finding constant / variable sites")
+def variant_masks(stack, min_pf, min_pn):
+    """
+    Return (snv_mask, var_mask) over the columns of a nibble stack whose first row is the reference.
+    snv_mask flags any informative mismatch; var_mask additionally applies the min-pf/min-pn filters.
+    """
     ref = stack[0]
     samples = stack[1:]
-    n_samples = samples.shape[0]
 
     # Count matches against ref, ignoring N's
-    is_match = (samples == ref) & (samples != 'N')
+    is_match = (samples == ref) & (samples != 0)
     n_matches = np.sum(is_match, axis=0)
 
     # Count informative samples (exclude N's)
-    informative = np.sum(samples != 'N', axis=0)
+    informative = np.count_nonzero(samples, axis=0)
+    return masks_from_counts(n_matches, informative, min_pf, min_pn)
 
+def masks_from_counts(n_matches, informative, min_pf, min_pn):
+    """`variant_masks` from per-site counts of reference matches and informative (non-N) samples."""
     # Find SNVs (at least one informative mismatch)
-    var_mask = (n_matches < informative)
-    logging.info(f"Found {np.sum(var_mask)} variants")
+    snv_mask = (n_matches < informative)
+    var_mask = snv_mask
 
     # Apply frequency/number filters if requested
     if min_pf > 0 or min_pn > 0:
         frac_nonref = (informative - n_matches) / np.maximum(informative, 1)  # avoid div/0
         num_nonref = informative - n_matches
         var_mask = var_mask & (frac_nonref >= min_pf) & (num_nonref >= min_pn)
+    return snv_mask, var_mask
+
+def write_fconst(const, ploidy, filename='fconst.txt'):
+    """Save base composition of constant sites; `const` is a bincount over nibble masks."""
+    with open(filename, 'w') as f:
+        f.write(f"{const[IUPAC_BITS['A']]*ploidy},"
+                f"{const[IUPAC_BITS['C']]*ploidy},"
+                f"{const[IUPAC_BITS['G']]*ploidy},"
+                f"{const[IUPAC_BITS['T']]*ploidy}\n")
+    logging.info(f'Saved file -> {filename}')
+
+def find_const(stack, names, ploidy, min_pf, min_pn):
+    """Write fconst.txt and return the variant columns of `stack` with their site mask."""
+    logging.info("Finding constant / variable sites")
+    ref = stack[0]
+
+    snv_mask, var_mask = variant_masks(stack, min_pf, min_pn)
+    logging.info(f"Found {np.sum(snv_mask)} variants")
+    if min_pf > 0 or min_pn > 0:
         logging.info(f"Filtered to {np.sum(var_mask)} variants (min-pf: {min_pf}, min-pn: {min_pn})")
 
     # Constant = everything else
@@ -98,20 +135,136 @@ def find_const(stack, names, ploidy, min_pf, min_pn):
     logging.info(f"Remaining {np.sum(const_mask)} sites treated as constant")
 
     # Count constant bases (using ref row)
-    const = Counter(ref[const_mask])
+    const = np.bincount(ref[const_mask], minlength=16)
     vars = stack[:, var_mask]
 
     # Ensure vars has consistent shape even if empty
     if vars.shape[1] == 0:
         vars = np.empty((stack.shape[0], 0), dtype=stack.dtype)
 
-    # Save base composition of constants
-    filename = 'fconst.txt'
-    with open(filename, 'w') as f:
-        f.write(f"{const.get('A',0)*ploidy},"
-                f"{const.get('C',0)*ploidy},"
-                f"{const.get('G',0)*ploidy},"
-                f"{const.get('T',0)*ploidy}\n")
-    logging.info(f'Saved file -> {filename}')
+    write_fconst(const, ploidy)
+
+    return vars, var_mask
+
+def count_calls(stack, block_cells=1 << 22):
+    """
+    Fused filter/core/const counters from one pass over column blocks of a nibble stack
+    (row 0 = reference):
+      valid   : reference position is called
+      called  : per-sample calls at valid positions (genome fraction numerator)
+      calls   : per-site non-N calls
+      matches : per-site calls equal to the reference call (the reference included)
+    Only (n_samples, block) temporaries are created.
+    """
+    n_rows, n_cols = stack.shape
+    valid = stack[0] > 0
+    called = np.zeros(n_rows, dtype=np.int64)
+    # per-site counters in the smallest type holding n_rows (uint8 below 256 samples)
+    calls = np.zeros(n_cols, dtype=np.min_scalar_type(n_rows))
+    matches = np.zeros(n_cols, dtype=calls.dtype)
+    step = max(1, block_cells // max(n_rows, 1))
+    for start in range(0, n_cols, step):
+        block = stack[:, start:start + step]
+        nz = block != 0
+        calls[start:start + step] = np.count_nonzero(nz, axis=0)
+        called += np.count_nonzero(nz[:, valid[start:start + step]], axis=1)
+        np.equal(block, block[0], out=nz)
+        matches[start:start + step] = np.count_nonzero(nz, axis=0)
+    return {'valid': valid, 'called': called, 'calls': calls, 'matches': matches}
+
+def filter_counts(counts, stack, names, min_gf=0.9):
+    """
+    `filter_sequences` on the counters: genome fractions and the keep-mask. The per-site counts
+    are updated in place to cover kept samples only.
+    """
+    n_valid = int(np.count_nonzero(counts['valid']))
+    logging.info(f"Removed {stack.shape[1] - n_valid} invalid reference positions")
+    gf = (counts['called'] / n_valid).astype(float)
+    keep = flag_low_gf(gf, names, min_gf)
+    for row in np.flatnonzero(~keep):
+        counts['calls'] -= stack[row] != 0
+        counts['matches'] -= stack[row] == stack[0]
+    return gf, keep
+
+def min_count(threshold, n):
+    """Smallest count k with k / n >= threshold in float64, so integer counts reproduce the fraction test."""
+    k = min(max(0, int(np.ceil(threshold * n))), n + 1)
+    while k > 0 and (k - 1) / n >= threshold:
+        k -= 1
+    while k <= n and k / n < threshold:
+        k += 1
+    return k
+
+def core_from_counts(counts, stack, names, gf, keep, threshold=1.0, progressive=True, plot='svg'):
+    """
+    `find_core` on the counters of kept samples. Returns the core site mask over all `stack`
+    columns (invalid reference positions excluded) and the per-sample core fractions of the
+    kept samples.
+    """
+    valid = counts['valid']
+    n_cols = int(np.count_nonzero(valid))
+    rows = np.flatnonzero(keep)
+    names = np.array(names)[rows]
+    if not progressive:
+        logging.info('Determining core (non-progressive)')
+        core_mask = counts['calls'] >= min_count(threshold, len(rows))
+        core_mask &= valid
+        n_core = np.count_nonzero(core_mask)
+        logging.info(f"Sites below min-cf ({threshold}): {n_cols - n_core}")
+        logging.info(f"Final core fraction: {n_core / n_cols:.2f}")
+        return core_mask, [np.nan] * len(rows)
+
+    logging.info('Determing soft-core (progressive):')
+    gf = gf[rows]
+    order = np.concatenate(([0], np.argsort(gf[1:])[::-1] + 1))
+    sorted_names = names[order]
+
+    # Running per-site count of non-N calls, one sample at a time, compared with the smallest
+    # count that reaches the threshold (no per-site fractions)
+    running = np.zeros(len(valid), dtype=np.min_scalar_type(len(rows) + 1))
+    core_mask = np.empty(len(valid), dtype=bool)
+    cfs = []
+    per_sample_cf = {}
+    for i, row in enumerate(rows[order], start=1):
+        running += stack[row] != 0
+        np.greater_equal(running, min_count(threshold, i), out=core_mask)
+        core_mask &= valid
+        core_fraction = np.count_nonzero(core_mask) / n_cols
+        cfs.append(core_fraction)
+        per_sample_cf[sorted_names[i-1]] = core_fraction
+        logging.info(f"  {i}/{len(rows)}: {sorted_names[i-1]} ({core_fraction:.2f})")
+
+    logging.info(f"Sites below min-cf ({threshold}): {n_cols - np.count_nonzero(core_mask)}")
+    logging.info(f"Final core fraction: {core_fraction:.2f}")
+    if plot:
+        create_plot(cfs, sorted_names, plot)
+    return core_mask, [per_sample_cf[n] for n in names]
+
+def const_from_counts(counts, stack, core_mask, ploidy, min_pf, min_pn):
+    """`find_const` on the counters: writes fconst.txt and returns the variant site mask over all columns."""
+    logging.info("Finding constant / variable sites")
+    # the reference is called at core sites, so it is one of the calls and one of the matches
+    n_matches = counts['matches'][core_mask] - 1
+    informative = counts['calls'][core_mask] - 1
+    snv_mask, var_mask = masks_from_counts(n_matches, informative, min_pf, min_pn)
+    logging.info(f"Found {np.sum(snv_mask)} variants")
+    if min_pf > 0 or min_pn > 0:
+        logging.info(f"Filtered to {np.sum(var_mask)} variants (min-pf: {min_pf}, min-pn: {min_pn})")
+    logging.info(f"Remaining {np.sum(~var_mask)} sites treated as constant")
+    # bincount converts to intp, so count the constant reference calls a block at a time
+    const_calls = stack[0][core_mask][~var_mask]
+    const = np.zeros(16, dtype=np.int64)
+    for start in range(0, len(const_calls), 1 << 20):
+        const += np.bincount(const_calls[start:start + (1 << 20)], minlength=16)
+    write_fconst(const, ploidy)
+
+    variant_sites = np.zeros_like(core_mask)
+    variant_sites[core_mask] = var_mask
+    return variant_sites
 
-    return vars
\ No newline at end of file
+def take_sites(stack, rows, site_mask):
+    """stack[rows][:, site_mask] as a single copy, one row at a time (np.compress would build an index array)."""
+    out = np.empty((len(rows), int(np.count_nonzero(site_mask))), dtype=stack.dtype)
+    for k, row in enumerate(rows):
+        out[k] = stack[row][site_mask]
+    return out
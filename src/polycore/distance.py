@@ -1,20 +1,28 @@
 from typing import List, Tuple, Dict, Optional
-from .utils import IUPAC_BITS, ALLELES, POPCOUNT16, ambiguity_size
-import numpy as np, logging
+from .utils import IUPAC_BITS, ALLELES, POPCOUNT16, MB, ambiguity_size, available_memory
+import numpy as np, logging, hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 def to_bits(sequences: np.ndarray, lut) -> np.ndarray:
+    """
+    Map a character array ('U1') to IUPAC bitmasks through the 128-entry `lut`.
+
+    Stacks from `create_stack` are already bit-encoded (uint8) and are returned unchanged.
+    """
+    if sequences.dtype == np.uint8:
+        return sequences
     logging.info('Converting variants to bits')
-    up = np.char.upper(sequences)
-    codes_obj = np.frompyfunc(ord, 1, 1)(up)
-    codes_int = codes_obj.astype(np.int32)
-    if np.any(codes_int > 127):
-        bad_chars = np.unique(up[codes_int > 127])
+    # 'U1' stores one UCS4 code point per cell, so the buffer reads directly as uint32 codes
+    codes = np.asarray(sequences, dtype='U1').view(np.uint32)
+    non_ascii = codes > 127
+    if np.any(non_ascii):
+        bad_chars = np.unique(np.char.upper(np.asarray(sequences, dtype='U1')[non_ascii]))
         bad_desc = ", ".join(f"{repr(c)} (U+{ord(c):04X})" for c in bad_chars)
         raise ValueError(
             f"Non-ASCII character(s) detected in sequences: {bad_desc}. "
             "Please sanitize the FASTA to ASCII IUPAC letters (A,C,G,T and ambiguity codes) and '-' only."
         )
-    codes = codes_int.astype(np.uint8)
+    # lut holds both cases, so no upper-casing pass is needed
     return lut[codes]
 
 def build_match_table(ploidy: int) -> np.ndarray:
@@ -55,11 +63,347 @@ def _mask_to_counts(mask: int, ploidy: int) -> np.ndarray:
         counts[:] = 0
     return counts
 
-def calculate_distances(bits: np.ndarray, ploidy: int, chunk_size: int) -> np.ndarray:
+def build_mismatch_table(ploidy: int) -> np.ndarray:
+    """Table[m1, m2] = number of mismatching copies between two masks (0 where either is unknown)."""
+    table = ploidy - build_match_table(ploidy).astype(np.int64)
+    table[0, :] = 0
+    table[:, 0] = 0
+    return table
+
+def _one_hot(chunk: np.ndarray, codes: np.ndarray, dtype) -> np.ndarray:
+    """(n, w) masks -> (n, w * len(codes)) indicator matrix over the given codes."""
+    n, w = chunk.shape
+    return (chunk[:, :, None] == codes).astype(dtype).reshape(n, w * codes.size)
+
+def pairwise_block(rows: np.ndarray, cols: np.ndarray, mismatch: np.ndarray) -> np.ndarray:
+    """
+    Summed mismatches between every row of `rows` and every row of `cols` over one site chunk.
+
+    Each sample becomes a one-hot (site, mask) matrix, so the whole block is
+    onehot(rows) @ (onehot(cols) @ mismatch.T).T -- one matrix multiply instead of a pair loop.
+    """
+    codes = np.union1d(np.unique(rows), np.unique(cols))
+    codes = codes[codes > 0]
+    out = np.zeros((rows.shape[0], cols.shape[0]), dtype=np.int64)
+    if codes.size == 0:
+        return out
+    sub = mismatch[np.ix_(codes, codes)]
+    # float32 is exact while the largest possible sum fits in its 24-bit mantissa
+    w = rows.shape[1]
+    dtype = np.float32 if int(sub.max()) * w < 2**24 else np.float64
+    x = _one_hot(rows, codes, dtype)
+    z = (cols[:, :, None] == codes).astype(dtype) @ sub.T.astype(dtype)
+    z = z.reshape(cols.shape[0], w * codes.size)
+    np.rint(x @ z.T, out=out, casting='unsafe')
+    return out
+
+def valid_codes(ploidy: int) -> int:
+    """Number of non-zero masks the stack can hold at this ploidy (one allele, or exactly `ploidy`)."""
+    return sum(1 for m in range(1, 16) if POPCOUNT16[m] in (1, ploidy))
+
+def auto_chunk_size(n: int, n_sites: int, ploidy: int, threads: int = 1, block_size: int = 256,
+                    tile_memory: int = 16 * MB, safety_fraction: float = 0.8,
+                    min_chunk: int = 1000) -> Tuple[int, int, int]:
+    """
+    Plan (chunk_size, block_size, threads) for `calculate_distances` from a model of what the
+    engine allocates.
+
+    Fixed: the condensed upper triangle in the smallest dtype holding ploidy * n_sites.
+    Per thread and site: `pairwise_block` on an (edge, w) tile builds the row one-hot matrix,
+    the column one-hot matrix and its product with the mismatch table, each edge * codes
+    floats wide, plus a boolean comparison temporary.
+
+    Each thread's tile working set targets `tile_memory` (larger chunks are no faster), but a
+    chunk is not made shorter than `min_chunk` sites. The smaller of the host's available
+    memory and the cgroup headroom, times `safety_fraction`, is a hard limit: when `min_chunk`
+    sites do not fit it, the tile edge is halved down to 32 rows, then the thread count, then
+    the rest of the edge, and the chunk is only as long as the limit allows.
+    """
+    available, source = available_memory()
+    edge = max(1, min(block_size, n))
+    threads = max(1, threads)
+    codes = valid_codes(ploidy)
+    fixed = n * (n - 1) // 2 * distance_dtype(ploidy, n_sites).itemsize
+    limit = available * safety_fraction
+    headroom = limit - fixed
+    floor = max(1, min(min_chunk, n_sites))
+
+    def per_site(itemsize: int) -> int:
+        return threads * edge * codes * (3 * itemsize + 1)
+
+    # float32 is only used while ploidy * chunk fits its mantissa (see pairwise_block)
+    while floor * per_site(4 if ploidy * floor < 2**24 else 8) > headroom:
+        if edge > 32:
+            edge = max(32, edge // 2)
+        elif threads > 1:
+            threads //= 2
+        elif edge > 1:
+            edge //= 2
+        else:
+            break
+    budget = min(threads * tile_memory, headroom)
+    for itemsize in (4, 8):
+        chunk = max(int(budget // per_site(itemsize)), min(floor, int(headroom // per_site(itemsize))))
+        if itemsize == 8 or ploidy * chunk < 2**24:
+            break
+    chunk = max(1, min(chunk, n_sites))
+    tiles = per_site(itemsize) * chunk
+    logging.info(f"Chunk plan: {chunk:,} sites per chunk ({-(-n_sites // chunk)} chunks); "
+                 f"tiles of {edge} x {edge} over {codes} codes in float{itemsize * 8} on {threads} thread(s) "
+                 f"~{tiles / MB:.0f} MB + {fixed / MB:.0f} MB matrix; "
+                 f"{available / MB:.0f} MB available ({source})")
+    if fixed + tiles > limit:
+        logging.warning(f"Distances for {n} samples need ~{(fixed + tiles) / MB:.0f} MB even with one site "
+                        f"per chunk on one thread, over the {limit / MB:.0f} MB budget")
+    return chunk, edge, threads
+
+def plan_tiles(n: int, block_size: int, threads: int = 1) -> List[Tuple[int, int, int, int]]:
+    """
+    Split the upper triangle of an (n, n) matrix into (r0, r1, c0, c1) tiles.
+
+    The tile edge is shrunk when needed so every worker gets a few tiles to balance load.
+    """
+    edge = max(1, min(block_size, n))
+    while threads > 1 and edge > 1:
+        k = -(-n // edge)
+        if k * (k + 1) // 2 >= 4 * threads:
+            break
+        edge = max(1, edge // 2)
+    return [(r0, min(r0 + edge, n), c0, min(c0 + edge, n))
+            for r0 in range(0, n, edge)
+            for c0 in range(r0, n, edge)]
+
+def _run_tiles(rows: np.ndarray, cols: np.ndarray, tiles, store, ploidy: int, chunk_size: int,
+               threads: int) -> None:
+    """
+    Sum the mismatches of every (rows, cols) tile over all site chunks and hand the tile's
+    int64 block to store(r0, c0, block). Tiles are disjoint, so `store` may write shared
+    output from the worker threads.
+    """
+    L = rows.shape[1]
+    mismatch = build_mismatch_table(ploidy)
+    logging.info(f"  {len(tiles)} tiles on {threads} thread(s)")
+
+    def run_tile(tile):
+        r0, r1, c0, c1 = tile
+        block = np.zeros((r1 - r0, c1 - c0), dtype=np.int64)
+        for start in range(0, L, chunk_size):
+            end = min(start + chunk_size, L)
+            block += pairwise_block(rows[r0:r1, start:end], cols[c0:c1, start:end], mismatch)
+        store(r0, c0, block)
+        return tile
+
+    # NumPy releases the GIL in the heavy kernels, so threads scale without copying `bits`
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        futures = [pool.submit(run_tile, t) for t in tiles]
+        for k, future in enumerate(as_completed(futures), 1):
+            r0, r1, c0, c1 = future.result()
+            logging.info(f"  Tile {k}/{len(tiles)}: rows {r0}-{r1} x {c0}-{c1}")
+
+def cross_distances(rows: np.ndarray, cols: np.ndarray, ploidy: int, chunk_size: int,
+                    threads: int = 1, block_size: int = 256) -> np.ndarray:
+    """(len(rows), len(cols)) mismatch counts between two sets of samples over the same sites."""
+    n_rows, n_cols = rows.shape[0], cols.shape[0]
+    out = np.zeros((n_rows, n_cols), dtype=np.int64)
+    tiles = [(r0, min(r0 + block_size, n_rows), c0, min(c0 + block_size, n_cols))
+             for r0 in range(0, n_rows, block_size)
+             for c0 in range(0, n_cols, block_size)]
+
+    def store(r0, c0, block):
+        out[r0:r0 + block.shape[0], c0:c0 + block.shape[1]] = block
+
+    _run_tiles(rows, cols, tiles, store, ploidy, chunk_size, threads)
+    return out
+
+def update_distances(bits: np.ndarray, names: List[str], sites: np.ndarray, ploidy: int,
+                     chunk_size: int, cache: Optional[dict], threads: int = 1,
+                     block_size: int = 256) -> 'CondensedMatrix':
+    """
+    Distances that reuse a previous run's matrix (see `io_ops.read_distance_cache`).
+
+    `sites` are the alignment positions of the columns of `bits`. A cached sample is reused when
+    its name is present and its calls at the cached sites are unchanged; then only new-vs-all
+    pairs are computed, plus the old-vs-old contribution of any sites added since. If cached
+    sites have dropped out of the variant set (e.g. the core shrank), every pair is recomputed.
+    """
+    n = bits.shape[0]
+    reusable = (cache is not None and cache['ploidy'] == ploidy
+                and np.all(np.isin(cache['sites'], sites)))
+    old, prev = [], []
+    if reusable:
+        cached_cols = np.flatnonzero(np.isin(sites, cache['sites']))
+        position = {name: i for i, name in enumerate(cache['names'])}
+        for i, name in enumerate(names):
+            j = position.get(name)
+            if j is not None and row_digest(bits[i, cached_cols]) == cache['digests'][j]:
+                old.append(i)
+                prev.append(j)
+    if not old:
+        logging.info("Distance cache not usable for the current variant sites; computing all pairs")
+        return calculate_distances(bits, ploidy, chunk_size, threads=threads)
+
+    reused = set(old)
+    new = [i for i in range(n) if i not in reused]
+    added_cols = np.flatnonzero(~np.isin(sites, cache['sites']))
+    logging.info(f"Reusing cached distances for {len(old)} samples; computing {len(new)} new samples "
+                 f"and {len(added_cols)} new sites")
+    diffs = CondensedMatrix.zeros(n, distance_dtype(ploidy, len(sites)))
+    cached = as_condensed(cache['diffs'])
+    added = (calculate_distances(bits[np.ix_(old, added_cols)], ploidy, chunk_size, threads)
+             if added_cols.size else None)
+    # `old` is ascending, so pair (old[a], old[b]) with a < b is an upper-triangle cell
+    for a in range(len(old) - 1):
+        values = cached.base_row(prev[a])[prev[a + 1:]].astype(np.int64)
+        if added is not None:
+            values += added.base_row(a)[a + 1:]
+        diffs.data[diffs.positions(old[a], np.array(old[a + 1:]))] = values
+    for start in range(0, len(new), block_size):
+        rows = new[start:start + block_size]
+        block = cross_distances(bits[rows], bits, ploidy, chunk_size, threads, block_size)
+        for i, row in zip(rows, block):
+            others = np.flatnonzero(np.arange(n) != i)
+            diffs.data[diffs.positions(i, others)] = row[others]
+    return diffs
+
+def row_digest(row: np.ndarray) -> str:
+    """Content digest of one sample's variant calls."""
+    return hashlib.blake2b(np.ascontiguousarray(row)).hexdigest()
+
+def calculate_distances(bits: np.ndarray, ploidy: int, chunk_size: int,
+                        threads: int = 1, block_size: int = 256) -> 'CondensedMatrix':
     """
     bits: (n_samples, n_sites) uint8 bitmasks (0=unknown, A=1, C=2, G=4, T=8, combos via OR)
+    threads: worker threads; tiles share `bits` in memory and write disjoint parts of the triangle
+    block_size: maximum tile edge (rows/columns per matrix multiply)
+
+    Returns the upper triangle in the smallest dtype that holds ploidy * n_sites. Self-distances
+    are 0 by construction (masks unknown at this ploidy could otherwise mismatch themselves).
     """
     logging.info(f"Calculating pairwise distances in {chunk_size} bp chunks")
+    n = bits.shape[0]
+    diffs = CondensedMatrix.zeros(n, distance_dtype(ploidy, bits.shape[1]))
+
+    def store(r0, c0, block):
+        for a in range(block.shape[0]):
+            i = r0 + a
+            j0 = max(c0, i + 1)
+            if j0 < c0 + block.shape[1]:
+                start = diffs.offset(i) + j0 - i - 1
+                diffs.data[start:start + c0 + block.shape[1] - j0] = block[a, j0 - c0:]
+
+    _run_tiles(bits, bits, plan_tiles(n, block_size, threads), store, ploidy, chunk_size, threads)
+    return diffs
+
+def distance_dtype(ploidy: int, n_sites: int) -> np.dtype:
+    """Smallest unsigned dtype that holds the largest possible distance."""
+    return np.min_scalar_type(max(ploidy * n_sites, 1))
+
+class CondensedMatrix:
+    """
+    Symmetric matrix with a zero diagonal, stored as its upper triangle (i < j) packed row by
+    row. `index` optionally selects and repeats rows/columns of the stored matrix (e.g. to
+    expand representatives to all samples); rows are only materialised on request.
+    """
+
+    def __init__(self, data: np.ndarray, n: int, index: Optional[np.ndarray] = None):
+        self.data = data
+        self.n = n
+        self.index = index
+
+    @classmethod
+    def zeros(cls, n: int, dtype) -> 'CondensedMatrix':
+        return cls(np.zeros(n * (n - 1) // 2, dtype=dtype), n)
+
+    @classmethod
+    def from_square(cls, square: np.ndarray) -> 'CondensedMatrix':
+        n = square.shape[0]
+        return cls(np.concatenate([square[i, i + 1:] for i in range(n)] or [square[:0, 0]]), n)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        m = self.n if self.index is None else len(self.index)
+        return m, m
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.data.dtype
+
+    @property
+    def size(self) -> int:
+        return self.shape[0] * self.shape[1]
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __iter__(self):
+        return (self.row(i) for i in range(self.shape[0]))
+
+    def __getitem__(self, key):
+        """Rows on demand: m[i], m[start:stop] and m[i, cols]."""
+        if isinstance(key, tuple):
+            i, cols = key
+            return self.row(i)[cols]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.shape[0])
+            if step != 1:
+                raise IndexError("CondensedMatrix row slices must be contiguous")
+            return self.rows(start, stop)
+        return self.row(key)
+
+    def max(self):
+        return self.data.max() if self.data.size else self.dtype.type(0)
+
+    def min(self):
+        return min(self.data.min(), 0) if self.data.size else self.dtype.type(0)
+
+    def offset(self, i: int) -> int:
+        """Position of cell (i, i + 1) in `data`."""
+        return i * self.n - i * (i + 1) // 2
+
+    def positions(self, i: int, others: np.ndarray) -> np.ndarray:
+        """Positions in `data` of cells (i, j) for each j in `others` (none equal to i)."""
+        lo, hi = np.minimum(i, others), np.maximum(i, others)
+        return lo * self.n - lo * (lo + 1) // 2 + hi - lo - 1
+
+    def base_row(self, i: int) -> np.ndarray:
+        """Row i of the stored (unindexed) matrix."""
+        row = np.empty(self.n, dtype=self.dtype)
+        row[:i] = self.data[self.positions(i, np.arange(i))]
+        row[i] = 0
+        row[i + 1:] = self.data[self.offset(i):self.offset(i) + self.n - i - 1]
+        return row
+
+    def row(self, i: int) -> np.ndarray:
+        i = int(i) + (self.shape[0] if i < 0 else 0)
+        if self.index is None:
+            return self.base_row(i)
+        return self.base_row(self.index[i])[self.index]
+
+    def rows(self, start: int, stop: int) -> np.ndarray:
+        stop = min(stop, self.shape[0])
+        out = np.empty((max(stop - start, 0), self.shape[1]), dtype=self.dtype)
+        for k, i in enumerate(range(start, stop)):
+            out[k] = self.row(i)
+        return out
+
+    def take(self, index: np.ndarray) -> 'CondensedMatrix':
+        """View with rows/columns `index` of this one."""
+        index = np.asarray(index, dtype=np.intp)
+        return CondensedMatrix(self.data, self.n, index if self.index is None else self.index[index])
+
+    def to_dense(self) -> np.ndarray:
+        return self.rows(0, self.shape[0])
+
+def as_condensed(diffs) -> CondensedMatrix:
+    """Square arrays (e.g. distance caches from older releases) as a CondensedMatrix."""
+    return diffs if isinstance(diffs, CondensedMatrix) else CondensedMatrix.from_square(np.asarray(diffs))
+
+def calculate_distances_reference(bits: np.ndarray, ploidy: int, chunk_size: int) -> np.ndarray:
+    """
+    Pair-by-pair implementation of `calculate_distances`, kept as the reference for tests.
+
+    bits: (n_samples, n_sites) uint8 bitmasks (0=unknown, A=1, C=2, G=4, T=8, combos via OR)
+    """
     n, L = bits.shape
     diffs = np.zeros((n, n), dtype=np.int64)
     match_table = build_match_table(ploidy)
@@ -67,7 +411,6 @@ def calculate_distances(bits: np.ndarray, ploidy: int, chunk_size: int) -> np.nd
     for start in range(0, L, chunk_size):
         end = min(start + chunk_size, L)
         chunk = bits[:, start:end]  # (n, w)
-        logging.info(f"  Processing sites {start}-{end}")
 
         for i in range(n):
             bi = chunk[i]
@@ -91,11 +434,18 @@ def calculate_distances(bits: np.ndarray, ploidy: int, chunk_size: int) -> np.nd
 
     return diffs
 
-def set_ploidy(sequences, bit_map, ploidy=None):
+def set_ploidy(sequences: np.ndarray, bit_map, ploidy=None):
     # Auto-detect ploidy if not specified
     if ploidy is None:
-        all_chars = set(''.join(sequences))
-        ploidy = max((ambiguity_size(c) for c in all_chars if ambiguity_size(c) > 0), default=1)
+        # Scan each row for codes wider than the current ploidy; stop once the widest is seen
+        max_size = max(ambiguity_size(c) for c in IUPAC_BITS)
+        ploidy = 1
+        for row in sequences:
+            data = row.tobytes()
+            ploidy = max((ambiguity_size(c) for c in IUPAC_BITS
+                          if ambiguity_size(c) > ploidy and c.encode() in data), default=ploidy)
+            if ploidy == max_size:
+                break
         logging.info(f"Auto-detected ploidy: {ploidy}")
     else:
         logging.info(f"Using specified ploidy: {ploidy}")
@@ -110,9 +460,27 @@ def set_ploidy(sequences, bit_map, ploidy=None):
         lut[ord(ch)] = lut[ord(ch.lower())] = bits
     return ploidy, bit_map_filt, lut
 
-def create_stack(sequences, bit_map):
+def nibble_table(bit_map) -> bytes:
+    """256-entry bytes.translate table: ASCII letter (either case) -> IUPAC mask, everything else -> 0."""
+    table = bytearray(256)
+    for ch, bits in bit_map.items():
+        table[ord(ch)] = table[ord(ch.lower())] = bits
+    return bytes(table)
+
+def encode_rows(rows: np.ndarray, table: bytes) -> np.ndarray:
+    """Translate a 2D uint8 ASCII array to nibble masks in place, one row at a time."""
+    for row in rows:
+        # bytes.translate maps every character in C without any index temporaries
+        row[:] = np.frombuffer(row.tobytes().translate(table), dtype=np.uint8)
+    return rows
+
+def create_stack(sequences: np.ndarray, bit_map) -> np.ndarray:
+    """
+    Encode an (n_samples, L) uint8 ASCII matrix as IUPAC nibble masks, in place.
+
+    Characters outside `bit_map` (N, gaps, ambiguity codes above the ploidy, non-ASCII)
+    are encoded as 0 and treated as missing from here on.
+    """
     logging.info(f"Creating array stack")
-    valid_bases = list(bit_map.keys())
-    logging.info(f"Valid bases: {valid_bases}")
-    stack = np.vstack([np.array(list(s), dtype='U1') for s in sequences])
-    return stack, valid_bases
\ No newline at end of file
+    logging.info(f"Valid bases: {list(bit_map.keys())}")
+    return encode_rows(sequences, nibble_table(bit_map))
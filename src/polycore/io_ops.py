@@ -1,7 +1,12 @@
 from typing import List, Tuple, Dict, Optional
-import numpy as np, logging, screed, os
-import plotly.graph_objects as go
-import plotly.io as pio
+import numpy as np, logging, os, gzip, bz2, tempfile, hashlib, shutil
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from .distance import row_digest, as_condensed, CondensedMatrix
+from .store import new_index, read_index, cached_row, open_rows, update_store
+from .collapse import ExpandedView
+from .bgzf import write_bgzf, virtual_offsets, write_index
+from .utils import IUPAC_ASCII
 
 def get_fasta_name(filepath):
     basename = os.path.basename(filepath)
@@ -13,94 +18,409 @@ def get_fasta_name(filepath):
     # Remove fasta extension and return
     return os.path.splitext(basename)[0]
 
-def load_sequences(files: List[str]) -> Tuple[List[str], List[str]]:
-    sequences, names = [], []
-    logging.info(f"Loading {len(files)} FASTA files...")
+# Upper-cases sequence bytes; line breaks and blanks are deleted in the same pass
+_UPPER = bytes.maketrans(b"abcdefghijklmnopqrstuvwxyz", b"ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+_WHITESPACE = b"\r\n\t "
+_BLOCK_SIZE = 1 << 20
+
+def open_fasta(filepath):
+    """Open a plain, gzip or bzip2 FASTA for binary reading (detected from the magic bytes)."""
+    with open(filepath, 'rb') as f:
+        magic = f.read(3)
+    if magic[:2] == b'\x1f\x8b':
+        return gzip.open(filepath, 'rb')
+    if magic == b'BZh':
+        return bz2.open(filepath, 'rb')
+    return open(filepath, 'rb')
+
+def iter_fasta_bytes(filepath):
+    """
+    Yield the upper-cased sequence bytes of all records in a FASTA, concatenated, in blocks.
+    Header lines are skipped; no per-record strings are built.
+    """
+    in_header = False
+    with open_fasta(filepath) as handle:
+        while True:
+            block = handle.read(_BLOCK_SIZE)
+            if not block:
+                break
+            pos = 0
+            while pos < len(block):
+                if in_header:
+                    nl = block.find(b'\n', pos)
+                    if nl < 0:
+                        break
+                    in_header = False
+                    pos = nl + 1
+                else:
+                    gt = block.find(b'>', pos)
+                    end = len(block) if gt < 0 else gt
+                    seq = block[pos:end].translate(_UPPER, _WHITESPACE)
+                    if seq:
+                        yield seq
+                    if gt < 0:
+                        break
+                    in_header = True
+                    pos = gt + 1
+
+def read_fasta_into(filepath, row: np.ndarray) -> Tuple[int, str]:
+    """
+    Decode a FASTA straight into a preallocated uint8 row.
+    Returns the sequence length and the blake2b digest of the sequence, hashed block by block.
+    """
+    offset = 0
+    digest = hashlib.blake2b()
+    for seq in iter_fasta_bytes(filepath):
+        digest.update(seq)
+        end = offset + len(seq)
+        if end <= row.shape[0]:
+            row[offset:end] = np.frombuffer(seq, dtype=np.uint8)
+        offset = end
+    return offset, digest.hexdigest()
+
+def sample_names(files: List[str]) -> List[str]:
+    """'Reference' followed by the sample file basenames, which must be unique."""
+    names = []
     for i, filepath in enumerate(files, 1):
         name = 'Reference' if i == 1 else get_fasta_name(filepath)
-        seq_parts = []
-        with screed.open(filepath) as handle:
-            for record in handle:
-                seq_parts.append(record['sequence'].upper())
-        seq = ''.join(seq_parts)
-        sequences.append(seq)
         if name in names:
             logging.error(f"ERROR: File basenames must be unique: {name}")
             exit(1)
         names.append(name)
-        seq_len = len(seq)
-        if i == 1:
-            ref_len = seq_len
-        if seq_len != ref_len:
-            raise ValueError(f"Sample length ({seq_len:,}) differs from the reference {ref_len:,}: {filepath}")
-        logging.info(f"  {i}/{len(files)}: {name} ({seq_len:,} bp)")
+    return names
+
+def _free_space(directory: str) -> int:
+    return shutil.disk_usage(directory).free
+
+def _shared_matrix(shape: Tuple[int, int]) -> Tuple[Optional[np.ndarray], Optional[str]]:
+    """
+    uint8 matrix backed by a file in /dev/shm (or the temp dir) that worker processes can map,
+    or (None, None) if neither has room for it. The file is sparse, so a filesystem that fills
+    up while it is written would kill the process with SIGBUS instead of raising.
+    """
+    size = shape[0] * shape[1]
+    candidates = (['/dev/shm'] if os.path.isdir('/dev/shm') else []) + [tempfile.gettempdir()]
+    for directory in candidates:
+        if _free_space(directory) >= size:
+            break
+        logging.info(f"Not enough free space in {directory} for the {size / (1 << 20):,.0f} MB shared matrix")
+    else:
+        return None, None
+    fd, path = tempfile.mkstemp(prefix='polycore-', suffix='.u8', dir=directory)
+    os.close(fd)
+    try:
+        matrix = np.memmap(path, dtype=np.uint8, mode='w+', shape=shape)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return matrix.view(np.ndarray), path
+
+def _read_shared_row(task) -> Tuple[int, str]:
+    """Worker: decode one FASTA into its row of the shared matrix."""
+    filepath, path, shape, row = task
+    matrix = np.memmap(path, dtype=np.uint8, mode='r+', shape=shape)
+    decoded = read_fasta_into(filepath, matrix[row])
+    matrix.flush()
+    return decoded
+
+def load_sequences(files: List[str], threads: int = 1,
+                   store: Optional[str] = None) -> Tuple[np.ndarray, List[str], List[str]]:
+    """
+    Load the reference and samples into one (n_files, L) uint8 matrix of upper-case ASCII.
+    Also returns the blake2b hex digest of every sequence, computed while decoding.
+
+    The reference is read first to learn L; every sample is then decoded directly into its row.
+    With threads > 1 the samples are decoded by a process pool writing into a shared-memory matrix.
+    With `store`, unchanged files are copied from the persistent alignment store instead of
+    being parsed, and new genomes are appended to it.
+    """
+    logging.info(f"Loading {len(files)} FASTA files...")
+    names = sample_names(files)
+
+    index = read_index(store) if store else None
+    cached = [cached_row(index, f) for f in files] if index else [None] * len(files)
+    if cached[0] is not None:
+        ref, ref_len = None, index['length']
+    else:
+        ref = b"".join(iter_fasta_bytes(files[0]))
+        ref_len = len(ref)
+        ref_digest = hashlib.blake2b(ref).hexdigest()
+        if index and index['length'] not in (None, ref_len):
+            logging.info(f"Alignment store {store} holds {index['length']:,} bp genomes; starting a new store")
+            index, cached = new_index(), [None] * len(files)
+    shape = (len(files), ref_len)
+    todo = [row for row in range(1, len(files)) if cached[row] is None]
+    path, pool = None, None
+    digests = []
+    try:
+        if threads > 1 and len(todo) > 1:
+            sequences, path = _shared_matrix(shape)
+        if path is not None:
+            pool = ProcessPoolExecutor(max_workers=threads)
+            tasks = [(files[row], path, shape, row) for row in todo]
+            decoded = pool.map(_read_shared_row, tasks, chunksize=max(1, len(tasks) // (4 * threads)))
+        else:
+            sequences = np.empty(shape, dtype=np.uint8)
+            decoded = (read_fasta_into(files[row], sequences[row]) for row in todo)
+        if ref is not None:
+            sequences[0] = np.frombuffer(ref, dtype=np.uint8)
+            del ref
+        if any(row is not None for row in cached):
+            stored = open_rows(store, index)
+            for i, row in enumerate(cached):
+                if row is not None:
+                    sequences[i] = stored[row]
+            del stored
+        decoded = iter(decoded)
+        for i, (filepath, name) in enumerate(zip(files, names), 1):
+            if cached[i - 1] is not None:
+                seq_len, digest = ref_len, index['hashes'][cached[i - 1]]
+            elif i == 1:
+                seq_len, digest = ref_len, ref_digest
+            else:
+                seq_len, digest = next(decoded)
+            digests.append(digest)
+            if seq_len != ref_len:
+                raise ValueError(f"Sample length ({seq_len:,}) differs from the reference {ref_len:,}: {filepath}")
+            logging.info(f"  {i}/{len(files)}: {name} ({seq_len:,} bp)")
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        if path is not None:
+            # the mapping stays valid after the backing file is unlinked
+            os.unlink(path)
+    if store:
+        update_store(store, index, files, names, sequences, cached, digests)
     logging.info(f"Loaded {len(sequences)} sequences")
-    return sequences, names
-
-def write_distances(names: List[str], diffs: np.ndarray) -> None:
-    """Write distance matrices in wide and long formats."""
-    # Wide format
-    filename = 'dist_wide.csv'
-    with open('dist_wide.csv', 'w') as f:
-        f.write("name," + ",".join(names) + "\n")
-        for name, row in zip(names, diffs):
-            row_str = ",".join(str(int(x)) if np.isfinite(x) else "" for x in row)
-            f.write(f"{name},{row_str}\n")
-    logging.info(f"Saved filed -> {filename}")
+    return sequences, names, digests
+
+def read_distance_cache(path: str) -> Optional[dict]:
+    """Load a distance cache written by `write_distance_cache`, or None if there is none yet."""
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return {
+            'names': data['names'].tolist(),
+            'sites': data['sites'],
+            'digests': data['digests'].tolist(),
+            'diffs': as_condensed(data['diffs']) if data['diffs'].ndim == 2 else
+                     CondensedMatrix(data['diffs'], len(data['names'])),
+            'ploidy': int(data['ploidy']),
+        }
+
+def write_distance_cache(path: str, names: List[str], sites: np.ndarray, bits: np.ndarray,
+                         diffs: CondensedMatrix, ploidy: int) -> None:
+    """
+    Save the rep-level distance matrix (as its condensed upper triangle) with the variant sites
+    and per-sample calls it was computed on.
+    """
+    with open(path, 'wb') as f:
+        np.savez(f, names=np.array(names), sites=sites,
+                 digests=np.array([row_digest(row) for row in bits]), diffs=as_condensed(diffs).data,
+                 ploidy=ploidy)
+    logging.info(f"Saved file -> {path}")
+
+DIST_FORMATS = ['wide', 'long', 'npy', 'triu']
+
+def write_distances(names: List[str], diffs, formats: List[str] = ('wide', 'long')) -> None:
+    """
+    Write the distance matrix (an ndarray or a CondensedMatrix, whose rows are expanded one
+    block at a time) in each of `formats`:
+      wide : dist_wide.csv, full matrix
+      long : dist_long.csv, one row per pair (i < j)
+      npy  : dist_matrix.npy, full matrix
+      triu : dist_triu.npy, upper triangle (i < j) packed row by row, in dist_long.csv order
+    The binary formats use the smallest unsigned dtype that holds the largest distance, can be
+    opened with np.load(..., mmap_mode='r') and share the sample order in dist_names.txt.
+    """
+    n = len(names)
+    # non-negative integer matrices are formatted in blocks; anything else cell by cell
+    blocked = diffs.dtype.kind in 'iu' and not (diffs.size and diffs.min() < 0)
+    if 'wide' in formats:
+        # Wide format
+        filename = 'dist_wide.csv'
+        with open('dist_wide.csv', 'wb') as f:
+            f.write(("name," + ",".join(names) + "\n").encode())
+            for lines in (_wide_lines(names, diffs) if blocked else _wide_lines_cellwise(names, diffs)):
+                f.write(lines)
+        logging.info(f"Saved filed -> {filename}")
     
-    # Long format
-    n_pairs = 0
-    filename = 'dist_long.csv'
-    with open('dist_long.csv', 'w') as f:
-        f.write("sample1,sample2,diff\n")
-        n = len(names)
-        for i in range(n):
-            for j in range(i+1, n):
-                d = int(diffs[i,j])
-                f.write(f"{names[i]},{names[j]},{d}\n")
-                n_pairs += 1
-    logging.info(f"Saved filed -> {filename}")
-    logging.info(f"Distance matrices: {n_pairs} pairwise comparisons")
+    if 'long' in formats:
+        # Long format
+        filename = 'dist_long.csv'
+        with open('dist_long.csv', 'wb') as f:
+            f.write(b"sample1,sample2,diff\n")
+            for lines in (_long_lines(names, diffs) if blocked else _long_lines_cellwise(names, diffs)):
+                f.write(lines)
+        logging.info(f"Saved filed -> {filename}")
+
+    if 'npy' in formats or 'triu' in formats:
+        dtype = np.min_scalar_type(int(diffs.max())) if diffs.size else np.uint8
+        with open('dist_names.txt', 'w') as f:
+            f.writelines(f"{name}\n" for name in names)
+        logging.info("Saved file -> dist_names.txt")
+        if 'npy' in formats:
+            matrix = np.lib.format.open_memmap('dist_matrix.npy', mode='w+', dtype=dtype, shape=(n, n))
+            for i in range(n):
+                matrix[i] = diffs[i]
+            matrix.flush()
+            logging.info("Saved file -> dist_matrix.npy")
+        if 'triu' in formats:
+            packed = np.lib.format.open_memmap('dist_triu.npy', mode='w+', dtype=dtype, shape=(n * (n - 1) // 2,))
+            k = 0
+            for i in range(n - 1):
+                packed[k:k + n - 1 - i] = diffs[i, i + 1:]
+                k += n - 1 - i
+            packed.flush()
+            logging.info("Saved file -> dist_triu.npy")
+    logging.info(f"Distance matrices: {n * (n - 1) // 2} pairwise comparisons")
+
+def _name_columns(names: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Names as a left-aligned (n, longest) byte matrix plus the mask of their bytes."""
+    encoded = [name.encode() for name in names]
+    width = max(map(len, encoded), default=0)
+    chars = np.frombuffer(b"".join(b.ljust(width, b"\0") for b in encoded), dtype=np.uint8)
+    lengths = np.array([len(b) for b in encoded], dtype=np.int64)
+    return chars.reshape(len(encoded), width), np.arange(width) < lengths[:, None]
+
+def _digit_columns(values: np.ndarray, width: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Decimal digits of non-negative integers right-aligned in `width` columns, plus the mask
+    of significant digits (the last one always, so 0 prints as '0')."""
+    values = values.astype(np.min_scalar_type(int(values.max())) if values.size else np.uint8)
+    digits = np.empty(values.shape + (width,), dtype=np.uint8)
+    mask = np.empty(digits.shape, dtype=bool)
+    mask[..., -1] = True
+    for k in range(width - 1, -1, -1):
+        values, digits[..., k] = np.divmod(values, 10)
+        if k:
+            # a digit is significant while the quotient left of it is non-zero
+            np.greater(values, 0, out=mask[..., k - 1])
+    digits += ord('0')
+    return digits, mask
+
+def _const_columns(text: bytes, rows: int) -> Tuple[np.ndarray, np.ndarray]:
+    chars = np.tile(np.frombuffer(text, dtype=np.uint8), (rows, 1))
+    return chars, np.ones(chars.shape, dtype=bool)
+
+def _pack_columns(*parts: Tuple[np.ndarray, np.ndarray]) -> bytes:
+    """Join (chars, mask) column groups side by side and keep the masked bytes, row by row."""
+    chars = np.concatenate([c for c, _ in parts], axis=1)
+    mask = np.concatenate([m for _, m in parts], axis=1)
+    return chars[mask].tobytes()
+
+def _wide_lines(names: List[str], diffs: np.ndarray, block_cells: int = 1 << 20):
+    """dist_wide.csv rows as byte blocks: 'name,d1,...,dn' for a block of rows at a time."""
+    n = len(names)
+    name_chars, name_mask = _name_columns(names)
+    width = len(str(int(diffs.max()))) if diffs.size else 1
+    step = max(1, block_cells // max(n, 1))
+    for start in range(0, n, step):
+        block = diffs[start:start + step]
+        rows = block.shape[0]
+        digits, mask = _digit_columns(block, width)
+        comma = np.full((rows, n, 1), ord(','), dtype=np.uint8)
+        cells = (np.concatenate([comma, digits], axis=2).reshape(rows, -1),
+                 np.concatenate([np.ones(comma.shape, dtype=bool), mask], axis=2).reshape(rows, -1))
+        yield _pack_columns((name_chars[start:start + rows], name_mask[start:start + rows]), cells,
+                            _const_columns(b"\n", rows))
+
+def _long_lines(names: List[str], diffs: np.ndarray):
+    """dist_long.csv rows as byte blocks: 'name_i,name_j,d' for j > i, one i at a time."""
+    n = len(names)
+    name_chars, name_mask = _name_columns(names)
+    width = len(str(int(diffs.max()))) if diffs.size else 1
+    for i in range(n - 1):
+        rows = n - 1 - i
+        yield _pack_columns(_const_columns(f"{names[i]},".encode(), rows),
+                            (name_chars[i + 1:], name_mask[i + 1:]),
+                            _const_columns(b",", rows),
+                            _digit_columns(diffs[i, i + 1:], width),
+                            _const_columns(b"\n", rows))
+
+def _wide_lines_cellwise(names: List[str], diffs: np.ndarray):
+    for name, row in zip(names, diffs):
+        row_str = ",".join(str(int(x)) if np.isfinite(x) else "" for x in row)
+        yield f"{name},{row_str}\n".encode()
+
+def _long_lines_cellwise(names: List[str], diffs: np.ndarray):
+    n = len(names)
+    for i in range(n):
+        for j in range(i+1, n):
+            d = int(diffs[i,j])
+            yield f"{names[i]},{names[j]},{d}\n".encode()
 
 def write_fasta_from_array(array: np.ndarray, names: List[str], filename: str) -> None:
     """
     Write a 2D array of bases (rows = samples, cols = bases) with associated names to a FASTA file.
 
     Args:
-        array: 2D numpy array of shape (n_samples, n_bases), dtype 'U1' or str.
+        array: 2D numpy array (or ExpandedView) of shape (n_samples, n_bases), uint8 IUPAC nibble masks.
         names: List of sample names (length n_samples).
         filename: Path to output FASTA file.
     """
     if array.shape[0] != len(names):
         raise ValueError("Number of names must match number of rows in array")
+    write_fasta_rows(array, names, filename)
 
+def write_fasta_rows(rows, names: List[str], filename: str) -> None:
+    """Write an iterable of nibble-mask rows, consumed one at a time, to a FASTA file."""
     with open(filename, "w") as f:
-        for name, row in zip(names, array):
-            seq = "".join(row.tolist())
+        for name, row in zip(names, rows):
+            seq = IUPAC_ASCII[row].tobytes().decode('ascii')
             f.write(f">{name}\n{seq}\n")
     logging.info(f'Saved file -> {filename}')
 
-def write_vcf_from_array(array: np.ndarray, names: List[str], filename: str) -> None:
+def write_vcf_from_array(array: np.ndarray, names: List[str], filename: str, compress: bool = False,
+                         index: Optional[str] = None, threads: int = 1) -> None:
     """
     Write a VCF file in the same style as `snp-sites -v`.
     
     Parameters
     ----------
-    array : np.ndarray
-        2D array of shape (n_samples, n_sites).
-        Values should be strings: REF base in column 0, ALT base in other entries,
-        or '0'/'1' already encoded as genotypes.
+    array : np.ndarray or ExpandedView
+        2D array of shape (n_samples, n_sites) of uint8 IUPAC nibble masks.
+        REF is taken from the first row; other bases become ALT alleles.
     names : List[str]
         Sample names, order matches rows in array.
     filename : str
         Path to output VCF file.
+    compress : bool
+        Write BGZF (bgzip-compatible) blocks, compressed on `threads` threads.
+    index : str, optional
+        With `compress`, also write a 'tbi' or 'csi' index next to the file.
     """
     if array.shape[0] != len(names):
         raise ValueError("Number of names must match number of rows in array")
 
-    n_sites = array.shape[1]
+    header = vcf_header(array.shape[1], names)
+    if not compress:
+        with open(filename, "wb") as f:
+            f.write(header)
+            for block in iter_vcf_records(array):
+                f.write(block)
+    elif index is None:
+        write_bgzf(filename, chain([header], iter_vcf_records(array)), threads)
+    else:
+        bounds = []
+        records = _record_bounds(iter_vcf_records(array), len(header), bounds)
+        blocks = write_bgzf(filename, chain([header], records), threads)
+        bounds = virtual_offsets(blocks, np.concatenate(bounds))
+        write_index(filename, index, "1", np.arange(array.shape[1]), bounds[:-1], bounds[1:])
+        logging.info(f"Saved file -> {filename}.{index}")
 
-    # Build header
+    logging.info(f"Saved file -> {filename}")
+
+def _record_bounds(blocks, offset: int, bounds: list):
+    """Pass `blocks` of whole lines through, appending the byte offset of every line start
+    (and finally the end of the data) to `bounds`."""
+    for block in blocks:
+        newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n"))
+        bounds.append(offset + np.r_[0, newlines[:-1] + 1])
+        offset += len(block)
+        yield block
+    bounds.append(np.array([offset]))
+
+def vcf_header(n_sites: int, names: List[str]) -> bytes:
     header = [
         "##fileformat=VCFv4.1",
         f"##contig=<ID=1,length={n_sites}>",
@@ -109,40 +429,60 @@ def write_vcf_from_array(array: np.ndarray, names: List[str], filename: str) ->
     cols = [
         "#CHROM", "POS", "ID", "REF", "ALT",
         "QUAL", "FILTER", "INFO", "FORMAT"
-    ] + names
-
-    with open(filename, "w") as f:
-        # Write header lines
-        for line in header:
-            f.write(line + "\n")
-        f.write("\t".join(cols) + "\n")
-
-        # Iterate over sites
-        for pos in range(n_sites):
-            # Column slice: genotypes at this site
-            site = array[:, pos]
-
-            # Define REF as allele in the first sample
-            ref = site[0]
-            alts = sorted(set(site) - {ref, "0"})
+    ] + list(names)
+    return ("\n".join(header) + "\n" + "\t".join(cols) + "\n").encode()
 
-            alt = ",".join(alts) if alts else "."
+# Mask -> rank of its IUPAC letter (0 and 15 both decode to 'N'), so ALT alleles come out
+# sorted like `sorted(set(letters))`
+_LETTERS, _LETTER_RANK = np.unique(IUPAC_ASCII, return_inverse=True)
+_LETTER_RANK = _LETTER_RANK.astype(np.uint8)
+_RANK_LETTER = [chr(c) for c in _LETTERS]
 
-            # Map alleles to 0 (REF) / 1 (ALT)
-            allele_map = {ref: "0"}
-            if alts:
-                for i, a in enumerate(alts, start=1):
-                    allele_map[a] = str(i)
+def iter_vcf_records(array: np.ndarray, block_cells: int = 1 << 24):
+    """
+    Yield the VCF records of `array` (samples x sites nibble masks) as byte blocks.
 
-            genotypes = [allele_map.get(x, "0") for x in site]
+    Per block of sites: the letters present at each site give the ALT list (sorted, REF
+    excluded) and a (site, letter) -> allele index table, from which the genotype matrix
+    is gathered at once and laid out as tab-separated ASCII digits.
+    """
+    n, n_sites = array.shape
+    step = max(1, block_cells // max(n, 1))
+    alt_cache: Dict[int, str] = {}
+    n_letters = len(_RANK_LETTER)
+    weights = 1 << np.arange(n_letters, dtype=np.int64)
+    for start in range(0, n_sites, step):
+        ranks = _LETTER_RANK[array[:, start:start + step]]
+        w = ranks.shape[1]
+        sites = np.arange(w)
+        present = np.zeros((w, n_letters), dtype=bool)
+        present[sites[None, :], ranks] = True
+        ref = ranks[0]
+        present[sites, ref] = False
+        # allele index of every letter: REF -> 0, ALT letters -> 1.. in letter order
+        codes = (np.cumsum(present, axis=1) - present + 1).astype(np.uint8)
+        codes[sites, ref] = 0
+        gt = codes[sites[None, :], ranks].T              # (w, n)
+        n_alts = present.sum(axis=1)
 
-            row = [
-                "1", str(pos + 1), ".", ref, alt,
-                ".", ".", ".", "GT"
-            ] + genotypes
-            f.write("\t".join(row) + "\n")
+        body = np.empty((w, 2 * n), dtype=np.uint8)
+        body[:, 0::2] = gt + ord('0')
+        body[:, 1::2] = ord('\t')
+        body[:, -1] = ord('\n')
 
-    logging.info(f"Saved file -> {filename}")
+        keys = present @ weights
+        lines = []
+        for i in range(w):
+            key = int(keys[i])
+            alt = alt_cache.get(key)
+            if alt is None:
+                alt = alt_cache[key] = ",".join(_RANK_LETTER[r] for r in np.flatnonzero(present[i])) or "."
+            prefix = f"1\t{start + i + 1}\t.\t{_RANK_LETTER[ref[i]]}\t{alt}\t.\t.\t.\tGT\t".encode()
+            if n_alts[i] < 10:
+                lines.append(prefix + body[i].tobytes())
+            else:
+                lines.append(prefix + "\t".join(map(str, gt[i])).encode() + b"\n")
+        yield b"".join(lines)
 
 def write_summary(names, stack, gf, cf, variants):
     """
@@ -154,8 +494,15 @@ def write_summary(names, stack, gf, cf, variants):
       - core fraction
       - variant count (if provided)
     """
-    length = stack.shape[1]
-    missing = np.sum(stack == 'N', axis=1)  # per-sample
+    if isinstance(stack, ExpandedView):
+        # count once per rep, then gather
+        missing = stack.expand(np.sum(stack.array == 0, axis=1))
+    else:
+        missing = np.sum(stack == 0, axis=1)  # per-sample
+    write_summary_counts(names, stack.shape[1], missing, gf, cf, variants)
+
+def write_summary_counts(names, length, missing, gf, cf, variants):
+    """`write_summary` from precomputed per-sample missing counts instead of the stack."""
     lines = ["name,length,missing,genome_fraction,core_fraction,variants"]
 
     for i, name in enumerate(names):
@@ -172,31 +519,3 @@ def write_summary(names, stack, gf, cf, variants):
     with open("summary.csv", "w") as f:
         f.write("\n".join(lines) + "\n")
     logging.info(f'Saved file -> summary.csv')
-
-def create_plot(core_fractions: List[float], names: List[str]) -> bool:
-    """Create core fraction progression plot."""
-    try:
-        logging.info("Creating progressive core plot")
-        if not core_fractions:
-            logging.info("No progression data for plotting")
-            return False
-        fig = go.Figure()
-        fig.add_trace(go.Scatter(
-            x=list(range(1, len(core_fractions)+1)),
-            y=core_fractions,
-            mode='lines+markers',
-            text=names[:len(core_fractions)],
-            hovertemplate='<b>%{text}</b><br>Order: %{x}<br>Core Fraction: %{y:.3f}<extra></extra>'
-        ))
-        fig.update_layout(
-            title='Soft-core Genome Fraction vs Sample Addition',
-            xaxis_title='Number of sequences included',
-            yaxis_title='Soft-core Genome Fraction',
-            width=900, height=520, showlegend=False
-        )
-        pio.write_html(fig, 'core_fraction_plot.html')
-        logging.info(f"core_fraction_plot.html: progression from {core_fractions[0]:.3f} to {core_fractions[-1]:.3f}")
-        return True
-    except ImportError:
-        logging.info("Progressive core plot failed, skipping...")
-        return False
\ No newline at end of file
@@ -0,0 +1,111 @@
+"""
+Progressive core fraction plot (core_fraction_plot.html).
+
+Backends:
+    svg        : small self-contained HTML page with an inline SVG chart, no dependencies
+    plotly     : interactive plotly figure with the plotly.js bundle inlined (~3.5 MB)
+    plotly-cdn : the same figure, loading plotly.js from the plotly CDN
+
+The SVG chart draws at most MAX_POINTS points (the per-bucket minimum and maximum of longer
+trajectories), so its size does not grow with the number of samples.
+"""
+from typing import List, Tuple, Dict, Optional
+import numpy as np, logging, html
+
+PLOT_BACKENDS = ['svg', 'plotly', 'plotly-cdn']
+PLOT_FILE = 'core_fraction_plot.html'
+TITLE = 'Soft-core Genome Fraction vs Sample Addition'
+X_TITLE = 'Number of sequences included'
+Y_TITLE = 'Soft-core Genome Fraction'
+MAX_POINTS = 1000
+
+def create_plot(core_fractions: List[float], names: List[str], backend: str = 'svg') -> bool:
+    """Create core fraction progression plot."""
+    logging.info("Creating progressive core plot")
+    if not len(core_fractions):
+        logging.info("No progression data for plotting")
+        return False
+    names = list(names[:len(core_fractions)])
+    if backend != 'svg':
+        try:
+            write_plotly(core_fractions, names, include_plotlyjs=True if backend == 'plotly' else 'cdn')
+        except ImportError:
+            logging.info("plotly is not installed, writing the SVG plot instead")
+            backend = 'svg'
+    if backend == 'svg':
+        write_svg(core_fractions, names)
+    logging.info(f"{PLOT_FILE}: progression from {core_fractions[0]:.3f} to {core_fractions[-1]:.3f}")
+    return True
+
+def write_plotly(core_fractions: List[float], names: List[str], include_plotlyjs=True,
+                 filename: str = PLOT_FILE) -> None:
+    # plotly is slow to import and optional (the 'viz' extra)
+    import plotly.graph_objects as go
+    import plotly.io as pio
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(
+        x=list(range(1, len(core_fractions)+1)),
+        y=core_fractions,
+        mode='lines+markers',
+        text=names,
+        hovertemplate='<b>%{text}</b><br>Order: %{x}<br>Core Fraction: %{y:.3f}<extra></extra>'
+    ))
+    fig.update_layout(
+        title=TITLE,
+        xaxis_title=X_TITLE,
+        yaxis_title=Y_TITLE,
+        width=900, height=520, showlegend=False
+    )
+    pio.write_html(fig, filename, include_plotlyjs=include_plotlyjs)
+
+def plot_points(values: np.ndarray, max_points: int = MAX_POINTS) -> np.ndarray:
+    """Indices to draw: all of them, or the minimum and maximum of each of max_points/2 buckets."""
+    n = len(values)
+    if n <= max_points:
+        return np.arange(n)
+    edges = np.linspace(0, n, max_points // 2 + 1).astype(int)
+    keep = [start + f(values[start:stop]) for start, stop in zip(edges[:-1], edges[1:])
+            for f in (np.argmin, np.argmax)]
+    return np.unique(keep)
+
+def write_svg(core_fractions: List[float], names: List[str], filename: str = PLOT_FILE,
+              width: int = 900, height: int = 520) -> None:
+    y = np.asarray(core_fractions, dtype=float)
+    n = len(y)
+    left, right, top, bottom = 80, 30, 60, 60
+    lo, hi = float(y.min()), float(y.max())
+    pad = (hi - lo) * 0.05 or 0.05
+    lo, hi = lo - pad, hi + pad
+
+    def sx(order):
+        return left + (order - 1) / max(n - 1, 1) * (width - left - right)
+
+    def sy(value):
+        return top + (hi - value) / (hi - lo) * (height - top - bottom)
+
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'font-family="sans-serif" font-size="12">',
+        f'<text x="{width / 2}" y="30" text-anchor="middle" font-size="16">{TITLE}</text>',
+        f'<text x="{(left + width - right) / 2}" y="{height - 15}" text-anchor="middle">{X_TITLE}</text>',
+        f'<text transform="translate(20,{(top + height - bottom) / 2}) rotate(-90)" '
+        f'text-anchor="middle">{Y_TITLE}</text>',
+    ]
+    for value in np.linspace(lo, hi, 6):
+        parts.append(f'<line x1="{left}" x2="{width - right}" y1="{sy(value):.1f}" y2="{sy(value):.1f}" '
+                     f'stroke="#e5e5e5"/><text x="{left - 8}" y="{sy(value) + 4:.1f}" '
+                     f'text-anchor="end">{value:.3f}</text>')
+    for order in np.unique(np.linspace(1, n, min(n, 6)).round().astype(int)):
+        parts.append(f'<text x="{sx(order):.1f}" y="{height - bottom + 18}" text-anchor="middle">{order}</text>')
+
+    keep = plot_points(y)
+    points = " ".join(f"{sx(i + 1):.1f},{sy(y[i]):.1f}" for i in keep)
+    parts.append(f'<polyline points="{points}" fill="none" stroke="#636efa" stroke-width="2"/>')
+    for i in keep:
+        parts.append(f'<circle cx="{sx(i + 1):.1f}" cy="{sy(y[i]):.1f}" r="3" fill="#636efa">'
+                     f'<title>{html.escape(str(names[i]))}\nOrder: {i + 1}\nCore Fraction: {y[i]:.3f}</title></circle>')
+    parts.append('</svg>')
+
+    with open(filename, 'w') as f:
+        f.write(f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{TITLE}</title></head>\n'
+                f'<body>\n{chr(10).join(parts)}\n</body></html>\n')
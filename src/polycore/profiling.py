@@ -0,0 +1,78 @@
+"""
+Per-stage resource report: wall and CPU time, resident memory and the arrays each stage
+produced. Logged as a table at the end of a run and optionally saved as JSON (--timings).
+
+CPU time includes finished worker processes. The peak RSS delta is how far a stage raised
+the process high-water mark (worker processes not included).
+"""
+from typing import List, Tuple, Dict, Optional
+from contextlib import contextmanager
+import numpy as np, logging, os, sys, time, json
+from .utils import MB
+
+def cpu_seconds() -> float:
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+def current_rss() -> int:
+    import psutil
+    return psutil.Process().memory_info().rss
+
+def peak_rss() -> int:
+    """High-water mark of the resident set size in bytes."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class StageReport:
+    """Collects one record per `stage()` block."""
+
+    def __init__(self):
+        self.stages: List[dict] = []
+        self.start = time.perf_counter()
+        self.cpu_start = cpu_seconds()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time the enclosed block. It may put the arrays it produced into the yielded dict;
+        only their shape, dtype and size are kept.
+        """
+        arrays: Dict[str, np.ndarray] = {}
+        wall, cpu, peak = time.perf_counter(), cpu_seconds(), peak_rss()
+        yield arrays
+        self.stages.append({
+            'stage': name,
+            'wall_s': time.perf_counter() - wall,
+            'cpu_s': cpu_seconds() - cpu,
+            'rss_mb': current_rss() / MB,
+            'peak_rss_delta_mb': (peak_rss() - peak) / MB,
+            'arrays': {key: {'shape': list(a.shape), 'dtype': str(a.dtype), 'mb': a.nbytes / MB}
+                       for key, a in arrays.items() if isinstance(a, np.ndarray)},
+        })
+        arrays.clear()  # the caller's dict must not keep the arrays alive
+
+    def totals(self) -> dict:
+        return {'wall_s': time.perf_counter() - self.start, 'cpu_s': cpu_seconds() - self.cpu_start,
+                'peak_rss_mb': peak_rss() / MB}
+
+    def log_table(self) -> None:
+        logging.info(f"{'Stage':<14}{'Wall s':>9}{'CPU s':>9}{'RSS MB':>10}{'Peak +MB':>10}  Arrays")
+        for s in self.stages:
+            arrays = ", ".join(f"{key} {'x'.join(map(str, a['shape']))} {a['dtype']} {a['mb']:.1f} MB"
+                               for key, a in s['arrays'].items())
+            logging.info(f"{s['stage']:<14}{s['wall_s']:>9.2f}{s['cpu_s']:>9.2f}{s['rss_mb']:>10.1f}"
+                         f"{s['peak_rss_delta_mb']:>10.1f}  {arrays}".rstrip())
+        t = self.totals()
+        logging.info(f"{'total':<14}{t['wall_s']:>9.2f}{t['cpu_s']:>9.2f}{'':>10}{'':>10}  "
+                     f"peak RSS {t['peak_rss_mb']:.1f} MB")
+
+    def write_json(self, path: str, **meta) -> None:
+        with open(path, 'w') as f:
+            json.dump({**meta, 'stages': self.stages, 'total': self.totals()}, f, indent=2)
+        logging.info(f"Saved file -> {path}")
@@ -0,0 +1,99 @@
+"""
+Persistent alignment store (--store DIR) reused across runs.
+
+    DIR/alignment.u8  row-major uint8 matrix of upper-case sequence bytes, one unique genome per row
+    DIR/index.json    alignment length, blake2b digest of every row, and the files already decoded
+                      (absolute path -> name, size, mtime and row)
+
+A file whose path, size and mtime match an index entry is served from the matrix without
+being parsed; anything else is decoded and only appended when its content is new.
+"""
+from typing import List, Tuple, Dict, Optional
+import numpy as np, logging, os, json
+
+MATRIX = 'alignment.u8'
+INDEX = 'index.json'
+
+def new_index() -> dict:
+    return {'version': 1, 'length': None, 'hashes': [], 'files': {}}
+
+def read_index(directory: str) -> dict:
+    """Load the store index, or an empty one if the store does not exist yet."""
+    path = os.path.join(directory, INDEX)
+    if not os.path.exists(path):
+        return new_index()
+    with open(path) as f:
+        return json.load(f)
+
+def write_index(directory: str, index: dict) -> None:
+    """Replace the index atomically so an interrupted run never leaves it half-written."""
+    path = os.path.join(directory, INDEX)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(path + '.tmp', path)
+
+def _stat_key(filepath: str) -> Tuple[str, int, int]:
+    st = os.stat(filepath)
+    return os.path.abspath(filepath), st.st_size, st.st_mtime_ns
+
+def cached_row(index: dict, filepath: str) -> Optional[int]:
+    """Store row of a file whose path, size and mtime are unchanged since it was indexed."""
+    path, size, mtime = _stat_key(filepath)
+    entry = index['files'].get(path)
+    if entry and entry['size'] == size and entry['mtime_ns'] == mtime:
+        return entry['row']
+    return None
+
+def open_rows(directory: str, index: dict) -> np.ndarray:
+    """Read-only memory map of all stored rows."""
+    shape = (len(index['hashes']), index['length'])
+    return np.memmap(os.path.join(directory, MATRIX), dtype=np.uint8, mode='r', shape=shape)
+
+def update_store(directory: str, index: dict, files: List[str], names: List[str],
+                 sequences: np.ndarray, rows: List[Optional[int]], digests: List[str]) -> dict:
+    """
+    Append the newly decoded rows of `sequences` (those with rows[i] None) whose content is
+    not stored yet, record every file in the index and save it. The stored digests double as
+    a persistent dedup index: `load_sequences` hands them back for cached rows. As in
+    `collapse_sequences`, a digest match is byte-compared, so a hash collision never makes
+    two different genomes share a row.
+    """
+    os.makedirs(directory, exist_ok=True)
+    if index['length'] is None:
+        index['length'] = sequences.shape[1]
+        # a fresh index never reuses a stale matrix
+        open(os.path.join(directory, MATRIX), 'wb').close()
+    by_hash: Dict[str, List[int]] = {}
+    for r, h in enumerate(index['hashes']):
+        by_hash.setdefault(h, []).append(r)
+    n_stored = len(index['hashes'])
+    appended: Dict[int, int] = {}  # store row -> row of `sequences`, for rows added by this call
+    n_new = 0
+    with open(os.path.join(directory, MATRIX), 'r+b') as out:
+        # rows appended by a run that died before saving its index are not indexed: overwrite them
+        out.truncate(n_stored * index['length'])
+        out.seek(0, os.SEEK_END)
+        stored = open_rows(directory, index) if n_stored else None
+
+        def same(r: int, seq: np.ndarray) -> bool:
+            return np.array_equal(sequences[appended[r]] if r in appended else stored[r], seq)
+
+        for i, (filepath, name) in enumerate(zip(files, names)):
+            row = rows[i]
+            if row is None:
+                digest = digests[i]
+                row = next((r for r in by_hash.get(digest, []) if same(r, sequences[i])), None)
+                if row is None:
+                    row = len(index['hashes'])
+                    by_hash.setdefault(digest, []).append(row)
+                    appended[row] = i
+                    index['hashes'].append(digest)
+                    out.write(sequences[i])
+                    n_new += 1
+            path, size, mtime = _stat_key(filepath)
+            index['files'][path] = {'name': name, 'size': size, 'mtime_ns': mtime, 'row': row}
+    write_index(directory, index)
+    n_cached = sum(r is not None for r in rows)
+    logging.info(f"Alignment store {directory}: {n_cached} cached, {n_new} new rows "
+                 f"({len(index['hashes'])} total)")
+    return index
@@ -0,0 +1,236 @@
+"""
+Streaming (--stream) pipeline.
+
+Unique genomes are spooled to a row-major uint8 file on disk and then processed in column
+windows, so only (n_samples, window) bytes of the alignment are in memory at any time.
+Everything the in-memory pipeline derives from the full stack (genome fraction, core mask,
+constant-site counts, variant columns) is accumulated window by window instead.
+"""
+from typing import List, Tuple, Dict, Optional
+import numpy as np, logging, os, hashlib, tempfile
+from .io_ops import (sample_names, iter_fasta_bytes, read_fasta_into, write_distances,
+                     write_fasta_rows, write_vcf_from_array, write_summary_counts,
+                     read_distance_cache, write_distance_cache)
+from .collapse import group_identical, expand_results, expand_distances, ExpandedView
+from .distance import (set_ploidy, nibble_table, encode_rows, auto_chunk_size, calculate_distances,
+                       update_distances)
+from .core_mask import flag_low_gf, variant_masks, write_fconst
+from .plot import create_plot
+from .profiling import StageReport
+from .utils import IUPAC_BITS
+
+def spool_sequences(files: List[str], path: str) -> Tuple[List[str], List[str], Dict[int, List[int]], int]:
+    """
+    Decode FASTAs one at a time and append each new (unique) genome to the file at `path`.
+
+    Returns:
+        names     : all sample names
+        rep_names : representative names, in the row order of the spool file
+        idx_map   : dict {rep_idx -> [orig_indices]}
+        ref_len   : alignment length
+    """
+    logging.info(f"Loading {len(files)} FASTA files...")
+    names = sample_names(files)
+    row = np.frombuffer(b"".join(iter_fasta_bytes(files[0])), dtype=np.uint8).copy()
+    ref_len = row.shape[0]
+
+    # (digest, spool row) keys; rows sharing a digest are byte-compared against the spool
+    keys, spooled = [], {}
+    stored = np.empty_like(row)
+    n_spooled = 0
+    with open(path, 'w+b') as out:
+        for i, (filepath, name) in enumerate(zip(files, names), 1):
+            if i == 1:
+                seq_len, digest = ref_len, hashlib.blake2b(row).hexdigest()
+            else:
+                seq_len, digest = read_fasta_into(filepath, row)
+            if seq_len != ref_len:
+                raise ValueError(f"Sample length ({seq_len:,}) differs from the reference {ref_len:,}: {filepath}")
+            logging.info(f"  {i}/{len(files)}: {name} ({seq_len:,} bp)")
+            for r in spooled.get(digest, []):
+                out.seek(r * ref_len)
+                out.readinto(stored)
+                if np.array_equal(stored, row):
+                    keys.append((digest, r))
+                    break
+            else:
+                out.seek(n_spooled * ref_len)
+                out.write(row)
+                spooled.setdefault(digest, []).append(n_spooled)
+                keys.append((digest, n_spooled))
+                n_spooled += 1
+    logging.info(f"Loaded {len(files)} sequences")
+
+    _, rep_names, idx_map = group_identical(keys, names)
+    return names, rep_names, idx_map, ref_len
+
+def read_rows(path: str, n_rows: int, length: int):
+    """Yield each full row of a row-major uint8 file, reusing one buffer."""
+    row = np.empty(length, dtype=np.uint8)
+    with open(path, 'rb', buffering=0) as f:
+        for _ in range(n_rows):
+            f.readinto(row)
+            yield row
+
+def iter_windows(path: str, n_rows: int, length: int, window: int):
+    """Yield (start, (n_rows, w) array) column windows of a row-major uint8 file, reusing one buffer."""
+    buffer = np.empty((n_rows, min(window, length)), dtype=np.uint8)
+    with open(path, 'rb', buffering=0) as f:
+        for start in range(0, length, window):
+            stop = min(start + window, length)
+            block = buffer[:, :stop - start]
+            for r in range(n_rows):
+                f.seek(r * length + start)
+                f.readinto(block[r])
+            yield start, block
+
+def run_stream(args, files: List[str], report: Optional[StageReport] = None) -> None:
+    """Run the whole pipeline over column windows of an on-disk alignment."""
+    report = report or StageReport()
+    with tempfile.TemporaryDirectory(prefix='polycore-') as tmp:
+        spool = os.path.join(tmp, 'alignment.u8')
+        with report.stage('load'):
+            orig_names, names_rep, idx_map, length = spool_sequences(files, spool)
+        n_rep = len(names_rep)
+        window = args.window_size
+
+        with report.stage('stack'):
+            ploidy, bit_map, _ = set_ploidy(read_rows(spool, n_rep, length), IUPAC_BITS, args.ploidy)
+            logging.info(f"Streaming {length:,} sites in windows of {window:,}")
+            logging.info(f"Valid bases: {list(bit_map.keys())}")
+            table = nibble_table(bit_map)
+
+        # Pass 1: valid reference positions and per-sample called sites -> genome fraction
+        with report.stage('filter'):
+            n_valid = 0
+            called = np.zeros(n_rep, dtype=np.int64)
+            for _, block in iter_windows(spool, n_rep, length, window):
+                encode_rows(block, table)
+                valid = block[0] > 0
+                n_valid += int(np.count_nonzero(valid))
+                called += np.count_nonzero(block[:, valid], axis=1)
+            logging.info(f"Removed {length - n_valid} invalid reference positions")
+            gf = (called / n_valid).astype(float)
+            filter_mask = flag_low_gf(gf, names_rep, args.min_gf)
+            names_filt = np.array(names_rep)[filter_mask]
+            gf_filt = gf[filter_mask]
+            n_kept = len(names_filt)
+
+        # Pass 2: core mask, constant/variant sites and core columns per window
+        with report.stage('core+const') as arrays:
+            if args.progressive:
+                logging.info('Determing soft-core (progressive):')
+                order = np.concatenate(([0], np.argsort(gf_filt[1:])[::-1] + 1))
+            else:
+                logging.info('Determining core (non-progressive)')
+                order = None
+            n_core_steps = np.zeros(n_kept, dtype=np.int64)
+            n_snv = 0
+            const = np.zeros(16, dtype=np.int64)
+            var_blocks, var_sites = [], []
+            core_store = os.path.join(tmp, 'core.u8')
+            n_core = 0
+            with open(core_store, 'wb') as core_out:
+                for start, block in iter_windows(spool, n_rep, length, window):
+                    encode_rows(block, table)
+                    valid = block[0] > 0
+                    kept = block[filter_mask][:, valid]
+                    core_mask = _window_core(kept, args.min_cf, order, n_core_steps)
+                    core = np.ascontiguousarray(kept[:, core_mask])
+                    for r in range(n_kept):
+                        core_out.seek(r * n_valid + n_core)
+                        core_out.write(core[r])
+                    n_core += core.shape[1]
+
+                    snv_mask, var_mask = variant_masks(core, args.min_pf, args.min_pn)
+                    n_snv += int(np.sum(snv_mask))
+                    const += np.bincount(core[0][~var_mask], minlength=16)
+                    var_blocks.append(core[:, var_mask])
+                    var_sites.append((start + np.flatnonzero(valid))[core_mask][var_mask])
+
+            if args.progressive:
+                sorted_names = names_filt[order]
+                cfs = n_core_steps / n_valid
+                for i, (sample_name, core_fraction) in enumerate(zip(sorted_names, cfs), 1):
+                    logging.info(f"  {i}/{n_kept}: {sample_name} ({core_fraction:.2f})")
+            logging.info(f"Sites below min-cf ({args.min_cf}): {n_valid - n_core}")
+            logging.info(f"Final core fraction: {n_core / n_valid:.2f}")
+            if args.progressive:
+                if not args.no_plot:
+                    create_plot(list(cfs), sorted_names, args.plot)
+                per_sample_cf = dict(zip(sorted_names, cfs))
+                cfs_filt = [per_sample_cf[n] for n in names_filt]
+            else:
+                cfs_filt = [np.nan] * n_kept
+
+            logging.info("Finding constant / variable sites")
+            vars = np.hstack(var_blocks) if var_blocks else np.empty((n_kept, 0), dtype=np.uint8)
+            logging.info(f"Found {n_snv} variants")
+            if args.min_pf > 0 or args.min_pn > 0:
+                logging.info(f"Filtered to {vars.shape[1]} variants (min-pf: {args.min_pf}, min-pn: {args.min_pn})")
+            logging.info(f"Remaining {n_core - vars.shape[1]} sites treated as constant")
+            write_fconst(const, ploidy)
+            arrays['vars'] = vars
+
+        with report.stage('distances') as arrays:
+            if args.chunk_size:
+                chunk_size, block_size, threads = args.chunk_size, 256, args.threads
+            else:
+                chunk_size, block_size, threads = auto_chunk_size(vars.shape[0], vars.shape[1], ploidy, args.threads)
+            if args.dist_cache:
+                sites = np.concatenate(var_sites) if var_sites else np.empty(0, dtype=np.int64)
+                diffs = update_distances(vars, list(names_filt), sites, ploidy, chunk_size,
+                                         read_distance_cache(args.dist_cache), threads=threads,
+                                         block_size=block_size)
+                write_distance_cache(args.dist_cache, list(names_filt), sites, vars, diffs, ploidy)
+            else:
+                diffs = calculate_distances(vars, ploidy, chunk_size, threads=threads, block_size=block_size)
+            arrays['diffs'] = diffs.data
+
+        # ---------------- Expansion + outputs ----------------
+        with report.stage('expand'):
+            no_mask = np.full(n_rep, True, dtype=bool)
+            missing_exp, names_exp = expand_results(n_valid - called, no_mask, idx_map, orig_names)
+            gf_exp, _ = expand_results(gf, no_mask, idx_map, orig_names)
+            cfs_exp, _ = expand_results(np.array(cfs_filt), filter_mask, idx_map, orig_names)
+            core_rows, names_core_exp = expand_results(np.arange(n_kept), filter_mask, idx_map, orig_names,
+                                                       keep_filtered=False)
+            vars_exp = ExpandedView(vars, filter_mask, idx_map, keep_filtered=False)
+            diffs0_exp, _ = expand_results(diffs.row(0), filter_mask, idx_map, orig_names)
+            diffs_exp, diffs_exp_names = expand_distances(diffs, filter_mask, idx_map, orig_names)
+
+        with report.stage('write'):
+            write_distances(diffs_exp_names, diffs_exp, args.dist_format)
+            write_fasta_rows(_read_core_rows(core_store, core_rows, n_valid, n_core), names_core_exp, "core.full.aln")
+            write_fasta_rows(vars_exp, names_core_exp, "core.aln")
+            write_vcf_from_array(vars_exp, names_core_exp, "core.vcf.gz" if args.vcf_compress else "core.vcf",
+                                 compress=args.vcf_compress, index=args.vcf_index, threads=args.threads)
+            write_summary_counts(names_exp, n_valid, missing_exp, gf_exp, cfs_exp, diffs0_exp)
+
+def _window_core(kept: np.ndarray, threshold: float, order: Optional[np.ndarray],
+                 n_core_steps: np.ndarray) -> np.ndarray:
+    """
+    Core mask of one window. For the progressive core, samples are added in `order` with a
+    running per-site count and each step's core-site count is added to `n_core_steps`.
+    """
+    n_rows, n_cols = kept.shape
+    if order is None:
+        return np.count_nonzero(kept, axis=0) / n_rows >= threshold
+    counts = np.zeros(n_cols, dtype=np.uint32)
+    fractions = np.empty(n_cols, dtype=float)
+    core_mask = np.empty(n_cols, dtype=bool)
+    for i, row in enumerate(order, start=1):
+        counts += kept[row] != 0
+        np.divide(counts, i, out=fractions)
+        np.greater_equal(fractions, threshold, out=core_mask)
+        n_core_steps[i - 1] += np.count_nonzero(core_mask)
+    return core_mask
+
+def _read_core_rows(path: str, rows: np.ndarray, stride: int, n_core: int):
+    """Yield core rows from the on-disk core store in the given (expanded) order."""
+    row = np.empty(n_core, dtype=np.uint8)
+    with open(path, 'rb', buffering=0) as f:
+        for r in rows:
+            f.seek(int(r) * stride)
+            f.readinto(row)
+            yield row
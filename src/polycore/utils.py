@@ -1,4 +1,4 @@
-import logging, psutil, numpy as np
+import logging, os, numpy as np
 from typing import List, Tuple, Dict, Optional
 
 IUPAC_BITS = {
@@ -7,18 +7,94 @@ IUPAC_BITS = {
     'B':2|4|8, 'D':1|4|8, 'H':1|2|8, 'V':1|2|4
 }
 ALLELES = [1,2,4,8]
+# Inverse of IUPAC_BITS as ASCII codes; mask 0 (unknown) decodes to 'N'
+IUPAC_ASCII = np.full(16, ord('N'), dtype=np.uint8)
+for _ch, _bits in IUPAC_BITS.items():
+    IUPAC_ASCII[_bits] = ord(_ch)
 POPCOUNT16 = np.array([bin(i).count("1") for i in range(16)], dtype=np.uint8)
+MB = 1 << 20
 
 def ambiguity_size(char: str) -> int:
     return bin(IUPAC_BITS.get(char.upper(), 0)).count('1')
 
+def decode_bases(array: np.ndarray) -> np.ndarray:
+    """Nibble masks -> 'U1' IUPAC letters (0 -> 'N')."""
+    return IUPAC_ASCII[array].view('S1').astype('U1')
+
 def set_up_logging():
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s - %(message)s',
                         datefmt='%H:%M:%S')
 
-def auto_chunk_size(n: int, safety_fraction: float = 0.8) -> int:
-    avail_bytes = psutil.virtual_memory().available
-    max_bytes = avail_bytes * safety_fraction
-    bytes_per_site = n * n if n > 0 else max_bytes
-    return max(1000, int(max_bytes / bytes_per_site))
+def _own_cgroups(proc_cgroup: str) -> Dict[str, str]:
+    """This process's cgroup path per hierarchy ('' for v2, 'memory' for the v1 memory controller)."""
+    own = {}
+    try:
+        with open(proc_cgroup) as f:
+            for line in f:
+                hierarchy, controllers, path = line.rstrip('\n').split(':', 2)
+                if hierarchy == '0' and not controllers:
+                    own[''] = path
+                elif 'memory' in controllers.split(','):
+                    own['memory'] = path
+    except (OSError, ValueError):
+        pass
+    return own
+
+def _cgroup_headroom(directory: str, limit_file: str, usage_file: str, inactive_key: str) -> Optional[int]:
+    """Headroom under one cgroup's own limit, None if it has none; OSError/ValueError if it is not readable."""
+    with open(os.path.join(directory, limit_file)) as f:
+        limit = f.read().strip()
+    with open(os.path.join(directory, usage_file)) as f:
+        usage = int(f.read())
+    if limit == 'max' or int(limit) >= 1 << 60:   # v1 reports "unlimited" as a huge number
+        return None
+    inactive = 0
+    try:
+        with open(os.path.join(directory, 'memory.stat')) as f:
+            for line in f:
+                key, value = line.split()
+                if key == inactive_key:
+                    inactive = int(value)
+    except (OSError, ValueError):
+        pass
+    return max(0, int(limit) - (usage - inactive))
+
+def cgroup_memory_available(root: str = '/sys/fs/cgroup', proc_cgroup: str = '/proc/self/cgroup') -> Optional[int]:
+    """
+    Bytes left under the tightest cgroup memory limit (v2 or v1) between this process's own
+    cgroup and the hierarchy root, or None without a limit.
+    Usage counts reclaimable inactive page cache out, like the kubelet's working set.
+    """
+    own = _own_cgroups(proc_cgroup)
+    for hierarchy, limit_file, usage_file, inactive_key in (
+            ('', 'memory.max', 'memory.current', 'inactive_file'),
+            ('memory', 'memory.limit_in_bytes', 'memory.usage_in_bytes', 'total_inactive_file')):
+        base = os.path.normpath(os.path.join(root, hierarchy))
+        directory = os.path.normpath(os.path.join(base, own.get(hierarchy, '/').lstrip('/')))
+        if not os.path.isdir(directory):   # inside a cgroup namespace `root` already is our cgroup
+            directory = base
+        found, tightest = False, None
+        while True:
+            try:
+                headroom = _cgroup_headroom(directory, limit_file, usage_file, inactive_key)
+                found = True
+                if headroom is not None and (tightest is None or headroom < tightest):
+                    tightest = headroom
+            except (OSError, ValueError):
+                pass
+            if directory == base:
+                break
+            directory = os.path.dirname(directory)
+        if found:
+            return tightest
+    return None
+
+def available_memory() -> Tuple[int, str]:
+    """Usable memory in bytes: the smaller of the host's available memory and the cgroup headroom."""
+    import psutil
+    host = psutil.virtual_memory().available
+    cgroup = cgroup_memory_available()
+    if cgroup is not None and cgroup < host:
+        return cgroup, 'cgroup limit'
+    return host, 'host'
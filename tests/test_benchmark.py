@@ -0,0 +1,27 @@
+import json
+import numpy as np
+from polycore.benchmark import generate_dataset, run_benchmarks, main
+from polycore.io_ops import load_sequences
+
+def test_generate_dataset(tmp_path):
+    files = generate_dataset(str(tmp_path), n_samples=6, length=3000, ploidy=3, ambiguity_rate=0.05,
+                             duplicate_rate=0.0, gzip_fraction=0.5)
+    sequences, names, digests = load_sequences(files)
+    assert sequences.shape == (7, 3000) and names[0] == "Reference"
+    letters = set(sequences[1:].tobytes().decode())
+    assert {"N", "B"} <= letters or {"N", "D"} <= letters        # N-runs and 3-allele codes
+    same = generate_dataset(str(tmp_path / "dup"), n_samples=4, length=500, duplicate_rate=1.0)
+    assert len(set(load_sequences(same)[2][1:])) == 1
+
+def test_benchmark_run_and_json(tmp_path):
+    files = generate_dataset(str(tmp_path / "data"), n_samples=8, length=5000)
+    work = tmp_path / "work"
+    work.mkdir()
+    timings = run_benchmarks(files, str(work))
+    assert {"load_sequences", "create_stack", "find_core", "find_const", "to_bits",
+            "calculate_distances", "write_vcf_from_array", "write_summary"} <= set(timings)
+    assert all(t >= 0 for t in timings.values()) and (work / "core.vcf").exists()
+    out = tmp_path / "bench.json"
+    main(["--scales", "5x2000", "--out", str(out)])
+    result = json.loads(out.read_text())
+    assert result["runs"][0]["scale"]["n_samples"] == 5 and "calculate_distances" in result["runs"][0]["timings"]
@@ -0,0 +1,71 @@
+import numpy as np
+from polycore.collapse import collapse_sequences
+
+def test_collapse_byte_compares_digest_matches():
+    rows = np.frombuffer(b"ACGTACGTTTGTACGT", dtype=np.uint8).reshape(4, 4).copy()
+    names = ["Reference", "a", "b", "c"]
+    # force a digest collision between different rows 1 and 2
+    unique, rep_names, idx_map = collapse_sequences(rows, names, ["r", "x", "x", "r"])
+    assert rep_names == ["Reference", "a", "b"]
+    assert idx_map == {0: [0, 3], 1: [1], 2: [2]}
+    assert unique.tobytes() == b"ACGTACGTTTGT"
+
+def test_collapse_near_duplicates_builds_consensus():
+    from polycore.collapse import collapse_near_duplicates
+    stack = np.array([
+        [1, 2, 4, 8, 0],   # reference; last site invalid
+        [1, 0, 4, 8, 2],
+        [1, 2, 0, 8, 4],   # agrees with row 1 wherever both are called (last site is not valid)
+        [2, 2, 4, 0, 0],   # conflicts at site 0
+    ], dtype=np.uint8)
+    idx_map = {0: [0], 1: [1, 4], 2: [2], 3: [3]}
+    names = ["Reference", "a", "b", "c"]
+    merged, rep_names, new_map = collapse_near_duplicates(stack, names, idx_map, chunk_size=2)
+    assert rep_names == ["Reference", "a", "c"]
+    assert new_map == {0: [0], 1: [1, 2, 4], 2: [3]}
+    assert merged[1].tolist() == [1, 2, 4, 8, 2]
+    assert merged[2].tolist() == [2, 2, 4, 0, 0]
+
+def test_expand_results_and_distances_gather_by_group():
+    from polycore.collapse import expand_results, expand_distances
+    from polycore.distance import CondensedMatrix
+    idx_map = {0: [0, 4], 1: [1], 2: [2, 3, 5]}
+    names = ["r", "a", "b", "c", "d", "e"]
+    mask = np.array([True, False, True])
+    values, exp_names = expand_results(np.array([[1, 2], [3, 4]], dtype=np.uint8), mask, idx_map, names)
+    assert exp_names == ["r", "d", "a", "b", "c", "e"]
+    assert np.array_equal(values, [[1, 2], [1, 2], [np.nan, np.nan], [3, 4], [3, 4], [3, 4]], equal_nan=True)
+    kept, kept_names = expand_results(np.array([7, 9], dtype=np.uint16), mask, idx_map, names, keep_filtered=False)
+    assert kept.dtype == np.uint16 and kept.tolist() == [7, 7, 9, 9, 9]
+    assert kept_names == ["r", "d", "b", "c", "e"]
+
+    square = np.array([[0, 5], [5, 0]])
+    dense, dist_names = expand_distances(square, mask, idx_map, names)
+    assert dist_names == kept_names
+    assert dense.tolist() == [[0, 0, 5, 5, 5], [0, 0, 5, 5, 5], [5, 5, 0, 0, 0], [5, 5, 0, 0, 0], [5, 5, 0, 0, 0]]
+    lazy, _ = expand_distances(CondensedMatrix.from_square(square), mask, idx_map, names)
+    assert np.array_equal(lazy.to_dense(), dense)
+
+def test_collapse_n_filters_low_coverage_samples_first(tmp_path, monkeypatch):
+    from polycore.cli import main
+    rng = np.random.default_rng(8)
+    ref = rng.choice(list("ACGT"), 2000)
+    seqs = {"ref": ref}
+    for i in range(1, 5):
+        seq = ref.copy()
+        seq[rng.random(2000) < 0.01] = "T"
+        seqs[f"s{i}"] = seq
+    low = seqs["s1"].copy()
+    low[rng.permutation(2000)[:1400]] = "N"   # compatible with s1 everywhere, gf 0.30
+    seqs["s5"] = low
+    files = []
+    for name, seq in seqs.items():
+        path = tmp_path / f"{name}.fa"
+        path.write_text(f">{name}\n" + "".join(seq) + "\n")
+        files.append(str(path))
+    monkeypatch.chdir(tmp_path)
+    main(["--ref", files[0], "--sample", *files[1:], "--min-gf", "0.9", "--collapse-n", "--no-plot"])
+
+    summary = dict(line.split(",", 1) for line in (tmp_path / "summary.csv").read_text().splitlines()[1:])
+    assert summary["s5"].startswith("2000,1400,0.300000,nan,")
+    assert ">s5" not in (tmp_path / "core.full.aln").read_text()
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from polycore.core_mask import (filter_sequences, find_core, find_const, count_calls, filter_counts,
+                                core_from_counts, const_from_counts, take_sites)
+
+@pytest.mark.parametrize("progressive", [False, True])
+def test_fused_counters_match_stage_functions(tmp_path, monkeypatch, progressive):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(4)
+    stack = rng.choice(np.array([1, 2, 4, 8, 5], dtype=np.uint8), size=(9, 300))
+    stack[rng.random(stack.shape) < 0.05] = 0
+    stack[0, :20] = 0                          # invalid reference positions
+    stack[3, :150] = 0                         # a sample below min_gf
+    names = np.array([f"s{i}" for i in range(9)])
+
+    stack_valid, gf, keep = filter_sequences(stack, names, 0.6)
+    core, names_core, cfs, _ = find_core(stack_valid[keep], names[keep], gf[keep], 0.8, progressive, None)
+    vars, _ = find_const(core, names_core, 2, 0.1, 0)
+    expected_fconst = (tmp_path / "fconst.txt").read_text()
+
+    counts = count_calls(stack, block_cells=64)
+    gf2, keep2 = filter_counts(counts, stack, names, 0.6)
+    assert np.array_equal(gf2, gf) and np.array_equal(keep2, keep) and not keep[3]
+    core_mask, cfs2 = core_from_counts(counts, stack, names, gf2, keep2, 0.8, progressive, None)
+    assert np.array_equal(cfs2, cfs, equal_nan=True)
+    assert np.array_equal(take_sites(stack, np.flatnonzero(keep2), core_mask), core)
+    var_sites = const_from_counts(counts, stack, core_mask, 2, 0.1, 0)
+    assert np.array_equal(take_sites(stack, np.flatnonzero(keep2), var_sites), vars)
+    assert (tmp_path / "fconst.txt").read_text() == expected_fconst
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_progressive_core_matches_recount(monkeypatch, seed):
+    from polycore import core_mask
+    rng = np.random.default_rng(seed)
+    stack = rng.choice(np.array([1, 2, 4, 8], dtype=np.uint8), size=(12, 200))
+    stack[rng.random(stack.shape) < 0.1] = 0
+    names = np.array([f"s{i}" for i in range(12)])
+    gf = np.round(np.count_nonzero(stack, axis=1) / 200, 1)   # rounded: ties in gf
+    assert len(np.unique(gf[1:])) < 11
+    trajectory = []
+    monkeypatch.setattr(core_mask, "create_plot", lambda cfs, names, backend: trajectory.extend(cfs))
+    core, _, cfs, mask = core_mask.find_core(stack, names, gf, threshold=0.8, progressive=True)
+
+    # original formula: re-count the first i sorted rows at every step
+    sort_indices = np.argsort(gf[1:])[::-1] + 1
+    sorted_stack = np.vstack([stack[0:1], stack[sort_indices]])
+    sorted_names = np.concatenate([names[0:1], names[sort_indices]])
+    expected, per_sample_cf = [], {}
+    for i in range(1, 13):
+        core_sites = np.sum(sorted_stack[0:i] != 0, axis=0) / i >= 0.8
+        expected.append(np.sum(core_sites) / 200)
+        per_sample_cf[sorted_names[i - 1]] = expected[-1]
+    assert trajectory == expected
+    assert cfs == [per_sample_cf[n] for n in names]
+    assert np.array_equal(mask, core_sites) and np.array_equal(core, stack[:, core_sites])
+
+def test_min_count_reproduces_fraction_threshold():
+    from polycore.core_mask import min_count
+    for n in range(1, 80):
+        counts = np.arange(n + 1)
+        for threshold in (0, 0.1, 1 / 3, 0.7, 0.9, 0.95, 0.99, 1.0, 1.5):
+            assert np.array_equal(counts >= min_count(threshold, n), counts / n >= threshold)
+
+def test_count_calls_uses_small_counters():
+    stack = np.ones((5, 1000), dtype=np.uint8)
+    counts = count_calls(stack, block_cells=512)
+    assert counts['calls'].dtype == counts['matches'].dtype == np.uint8
+    assert counts['calls'].tolist() == [5] * 1000 and counts['called'].tolist() == [1000] * 5
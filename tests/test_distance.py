@@ -0,0 +1,134 @@
+import logging
+import numpy as np
+import pytest
+from polycore.distance import calculate_distances, calculate_distances_reference, distance_dtype
+
+@pytest.mark.parametrize("ploidy", [1, 2, 3])
+def test_calculate_distances_matches_reference(ploidy):
+    rng = np.random.default_rng(ploidy)
+    bits = rng.integers(0, 16, size=(23, 157)).astype(np.uint8)
+    bits[rng.random(bits.shape) < 0.2] = 0
+    expected = calculate_distances_reference(bits, ploidy, chunk_size=50)
+    got = calculate_distances(bits, ploidy, chunk_size=50, block_size=5)
+    assert got.dtype == distance_dtype(ploidy, 157) == (np.uint8 if ploidy == 1 else np.uint16)
+    assert got.data.shape == (23 * 22 // 2,)
+    assert np.array_equal(got.to_dense(), expected)
+
+def test_calculate_distances_thread_count_invariant():
+    rng = np.random.default_rng(7)
+    bits = rng.choice(np.array([0, 1, 2, 4, 8, 5, 10], dtype=np.uint8), size=(41, 120))
+    expected = calculate_distances_reference(bits, 2, chunk_size=33)
+    for threads in (1, 3, 8):
+        got = calculate_distances(bits, 2, chunk_size=33, threads=threads, block_size=16)
+        assert np.array_equal(got.to_dense(), expected)
+
+def test_condensed_matrix_rows_and_take():
+    from polycore.distance import CondensedMatrix
+    rng = np.random.default_rng(3)
+    square = rng.integers(0, 200, size=(9, 9)).astype(np.uint8)
+    square = np.triu(square, 1) + np.triu(square, 1).T
+    m = CondensedMatrix.from_square(square)
+    assert m.shape == (9, 9) and m.max() == square.max()
+    assert np.array_equal(m.to_dense(), square)
+    assert np.array_equal(m[2:5], square[2:5]) and np.array_equal(m[4, 5:], square[4, 5:])
+    index = np.array([0, 0, 3, 8, 8, 8, 1])
+    view = m.take(index)
+    assert view.shape == (7, 7)
+    assert np.array_equal(view.to_dense(), square[np.ix_(index, index)])
+    assert np.array_equal(view.take([6, 2]).to_dense(), square[np.ix_([1, 3], [1, 3])])
+
+def test_create_stack_encodes_nibbles():
+    from polycore.distance import create_stack, set_ploidy
+    from polycore.utils import IUPAC_BITS, decode_bases
+    raw = np.frombuffer(b"ACGTNacgR-", dtype=np.uint8).reshape(2, 5).copy()
+    ploidy, bit_map, _ = set_ploidy(raw, IUPAC_BITS)
+    assert ploidy == 2
+    stack = create_stack(raw, bit_map)
+    assert stack.dtype == np.uint8
+    assert stack.tolist() == [[1, 2, 4, 8, 0], [1, 2, 4, 5, 0]]
+    assert "".join(decode_bases(stack[1])) == "ACGRN"
+
+def test_update_distances_reuses_cached_pairs():
+    from polycore.distance import update_distances, row_digest
+    rng = np.random.default_rng(11)
+    bits = rng.choice(np.array([0, 1, 2, 4, 8, 5], dtype=np.uint8), size=(12, 60))
+    names = [f"s{i}" for i in range(12)]
+    sites = np.arange(60) * 3
+    expected = calculate_distances_reference(bits, 2, chunk_size=60)
+
+    # previous run: first 8 samples on the first 50 sites; s2 has changed since
+    old_cols = np.arange(50)
+    previous = bits[:8, old_cols].copy()
+    previous[2, 0] = 0 if previous[2, 0] else 1
+    cache = {
+        "names": names[:8],
+        "sites": sites[old_cols],
+        "digests": [row_digest(r) for r in previous],
+        "diffs": calculate_distances_reference(previous, 2, chunk_size=50),
+        "ploidy": 2,
+    }
+    got = update_distances(bits, names, sites, 2, chunk_size=17, cache=cache, block_size=3)
+    assert np.array_equal(got.to_dense(), expected)
+
+    # a cached site that is no longer a variant forces a full recompute
+    cache["sites"] = np.append(cache["sites"][:-1], 1000)
+    assert np.array_equal(update_distances(bits, names, sites, 2, chunk_size=17, cache=cache).to_dense(), expected)
+
+def test_to_bits_vectorised():
+    from polycore.distance import to_bits, set_ploidy
+    from polycore.utils import IUPAC_BITS
+    _, _, lut = set_ploidy(None, IUPAC_BITS, ploidy=2)
+    chars = np.array([list("ACgtN"), list("rY-Bk")], dtype="U1")
+    assert to_bits(chars, lut).tolist() == [[1, 2, 4, 8, 0], [5, 10, 0, 0, 12]]
+    encoded = np.array([[1, 2]], dtype=np.uint8)
+    assert to_bits(encoded, lut) is encoded
+    with pytest.raises(ValueError, match=r"Non-ASCII character\(s\) detected in sequences: .*\(U\+00C9\)"):
+        to_bits(np.array([["A", "é"]], dtype="U1"), lut)
+
+def test_auto_chunk_size_models_engine(monkeypatch):
+    from polycore import distance
+    MB = 1 << 20
+    monkeypatch.setattr(distance, "available_memory", lambda: (1 << 30, "host"))
+    # small problem: the whole alignment in one chunk, never more than the alignment
+    assert distance.auto_chunk_size(10, 5000, ploidy=2) == (5000, 10, 1)
+    # 256-row tiles at ploidy 2: 10 codes, float32 -> 256 * 10 * 13 bytes per site and thread,
+    # sized to the per-thread tile target however much memory is free
+    chunk, _, _ = distance.auto_chunk_size(1000, 10**9, ploidy=2, min_chunk=1)
+    assert chunk == 16 * MB // (256 * 10 * 13)
+    assert distance.auto_chunk_size(1000, 10**9, ploidy=2, threads=4, min_chunk=1) == (chunk, 256, 4)
+    assert distance.auto_chunk_size(1000, 10**9, ploidy=2, tile_memory=64 * MB)[0] == 64 * MB // (256 * 10 * 13)
+    assert distance.auto_chunk_size(1000, 10**9, ploidy=2) == (1000, 256, 1)
+    # available memory is an upper limit: uint16 triangle of 100 samples, 100 * 10 * 13 bytes per site
+    monkeypatch.setattr(distance, "available_memory", lambda: (20 * MB, "cgroup limit"))
+    assert distance.auto_chunk_size(100, 10**4, ploidy=2, min_chunk=1)[0] == int((20 * MB * 0.8 - 4950 * 2) // 13000)
+    assert distance.auto_chunk_size(100, 10**4, ploidy=2, threads=4, min_chunk=1)[0] == int((20 * MB * 0.8 - 4950 * 2) // 52000)
+
+def test_auto_chunk_size_keeps_floor_within_budget(monkeypatch, caplog):
+    from polycore import distance
+    MB = 1 << 20
+    available = 1 << 30
+    monkeypatch.setattr(distance, "available_memory", lambda: (available, "cgroup limit"))
+    n, n_sites = 2000, 10**6
+    fixed = n * (n - 1) // 2 * 4
+    # 64 threads of 256-row tiles would need ~2 GB for the 1000-site floor: the edge shrinks instead
+    with caplog.at_level(logging.WARNING):
+        chunk, edge, threads = distance.auto_chunk_size(n, n_sites, ploidy=2, threads=64)
+    assert chunk >= 1000 and edge < 256 and threads == 64
+    assert fixed + threads * edge * 10 * 13 * chunk <= available * 0.8
+    assert not caplog.records
+    # tighter: threads go once the edge is down to 32 rows
+    available = 16 * MB
+    chunk, edge, threads = distance.auto_chunk_size(n, n_sites, ploidy=2, threads=64)
+    assert chunk >= 1000 and (edge, threads) == (32, 1)
+    assert fixed + threads * edge * 10 * 13 * chunk <= available * 0.8
+    # too little for the floor even with single-row tiles: the chunk shrinks below it
+    available = int((fixed + 500 * 130) / 0.8)
+    chunk, edge, threads = distance.auto_chunk_size(n, n_sites, ploidy=2, threads=64)
+    assert (edge, threads) == (1, 1) and chunk < 1000
+    assert fixed + threads * edge * 10 * 13 * chunk <= available * 0.8
+    assert not caplog.records
+    # not even the triangle fits: the smallest plan, with a warning
+    available = 1 << 20
+    with caplog.at_level(logging.WARNING):
+        assert distance.auto_chunk_size(n, n_sites, ploidy=2, threads=64) == (1, 1, 1)
+    assert "over the" in caplog.text
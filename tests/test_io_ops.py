@@ -0,0 +1,223 @@
+import gzip
+import logging
+import os
+import numpy as np
+import pytest
+from polycore.io_ops import load_sequences, write_vcf_from_array, write_distances
+from polycore.utils import decode_bases
+
+FASTA = ">chr1 first\nACGTN\nacgt\n>chr2\nRY-\n"
+
+def test_load_sequences_plain_and_gzip(tmp_path):
+    ref = tmp_path / "ref.fa"
+    ref.write_text(FASTA)
+    sample = tmp_path / "s1.fa.gz"
+    with gzip.open(sample, "wt") as f:
+        f.write(FASTA.lower())
+    sequences, names, digests = load_sequences([str(ref), str(sample)])
+    assert digests[0] == digests[1]
+    assert names == ["Reference", "s1"]
+    assert sequences.dtype == np.uint8 and sequences.shape == (2, 12)
+    assert sequences[0].tobytes() == b"ACGTNACGTRY-"
+    assert sequences[1].tobytes() == b"ACGTNACGTRY-"
+
+def test_load_sequences_length_mismatch(tmp_path):
+    ref = tmp_path / "ref.fa"
+    ref.write_text(FASTA)
+    sample = tmp_path / "s1.fa"
+    sample.write_text(">x\nACGT\n")
+    with pytest.raises(ValueError, match="differs from the reference"):
+        load_sequences([str(ref), str(sample)])
+
+def test_load_sequences_parallel_matches_serial(tmp_path):
+    files = []
+    for i, seq in enumerate(["ACGTACGT", "ACGTNNGT", "acgtacga", "RCGTACGT"]):
+        path = tmp_path / f"s{i}.fa.gz"
+        with gzip.open(path, "wt") as f:
+            f.write(f">s{i}\n{seq[:5]}\n{seq[5:]}\n")
+        files.append(str(path))
+    serial, names, digests = load_sequences(files)
+    parallel, parallel_names, parallel_digests = load_sequences(files, threads=2)
+    assert parallel_digests == digests
+    assert parallel_names == names
+    assert np.array_equal(parallel, serial)
+
+def test_load_sequences_parallel_without_shared_space(tmp_path, monkeypatch):
+    from polycore import io_ops
+    files = []
+    for i, seq in enumerate(["ACGTACGT", "ACGTNNGT", "TCGTACGT"]):
+        path = tmp_path / f"s{i}.fa"
+        path.write_text(f">s{i}\n{seq}\n")
+        files.append(str(path))
+    serial = load_sequences(files)[0]
+    # neither /dev/shm nor the temp dir can hold the matrix: decode serially in memory
+    monkeypatch.setattr(io_ops, "_free_space", lambda directory: 10)
+    assert io_ops._shared_matrix((3, 8)) == (None, None)
+    assert np.array_equal(load_sequences(files, threads=2)[0], serial)
+
+def test_load_sequences_parallel_cleans_up_on_error(tmp_path, monkeypatch):
+    from polycore import io_ops
+    files = []
+    for i, seq in enumerate(["ACGTACGT", "ACGTNNGT", "TCGTACGT", "GCGTACGT"]):
+        path = tmp_path / f"s{i}.fa"
+        path.write_text(f">s{i}\n{seq}\n")
+        files.append(str(path))
+    store = str(tmp_path / "store")
+    load_sequences(files[:2], store=store)
+    paths = []
+    shared = io_ops._shared_matrix
+    def recording(shape):
+        matrix, path = shared(shape)
+        paths.append(path)
+        return matrix, path
+    monkeypatch.setattr(io_ops, "_shared_matrix", recording)
+    def broken(directory, index):
+        raise OSError("store unreadable")
+    monkeypatch.setattr(io_ops, "open_rows", broken)
+    with pytest.raises(OSError, match="store unreadable"):
+        load_sequences(files, threads=2, store=store)
+    assert paths and not any(os.path.exists(p) for p in paths)
+
+def test_load_sequences_store_reuses_unchanged_files(tmp_path, caplog):
+    files = []
+    for i, seq in enumerate(["ACGTACGT", "ACGTNNGT", "ACGTACGT"]):
+        path = tmp_path / f"s{i}.fa"
+        path.write_text(f">s{i}\n{seq}\n")
+        files.append(str(path))
+    caplog.set_level(logging.INFO)
+    store = str(tmp_path / "store")
+    first, _, first_digests = load_sequences(files, store=store)
+    assert "2 new rows" in caplog.text  # s2 duplicates the reference
+
+    extra = tmp_path / "s3.fa"
+    extra.write_text(">s3\nTTTTACGT\n")
+    caplog.clear()
+    second, names, digests = load_sequences(files + [str(extra)], store=store)
+    assert digests[:3] == first_digests
+    assert "3 cached, 1 new rows" in caplog.text
+    assert names[-1] == "s3"
+    assert np.array_equal(second[:3], first)
+    assert second[3].tobytes() == b"TTTTACGT"
+    assert np.array_equal(second, load_sequences(files + [str(extra)])[0])
+
+def test_store_discards_rows_of_interrupted_run(tmp_path, monkeypatch):
+    from polycore import store as store_module
+    files = []
+    for i, seq in enumerate(["ACGTACGT", "CCCCACGT", "TTTTACGT", "GGGGACGT"]):
+        path = tmp_path / f"s{i}.fa"
+        path.write_text(f">s{i}\n{seq}\n")
+        files.append(str(path))
+    store = str(tmp_path / "store")
+    load_sequences(files[:2], store=store)
+
+    # the run adding s2 dies after appending its row but before saving the index
+    def interrupted(directory, index):
+        raise KeyboardInterrupt
+    with monkeypatch.context() as m:
+        m.setattr(store_module, "write_index", interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            load_sequences(files[:3], store=store)
+
+    load_sequences(files[:2] + [files[3]], store=store)
+    cached, names, _ = load_sequences(files[:2] + [files[3]], store=store)
+    assert cached[2].tobytes() == b"GGGGACGT"
+    assert np.array_equal(cached, load_sequences(files[:2] + [files[3]])[0])
+
+def test_store_byte_compares_digest_matches(tmp_path):
+    from polycore.store import new_index, update_store, open_rows
+    files = []
+    for i in range(4):
+        path = tmp_path / f"s{i}.fa"
+        path.write_text(f">s{i}\nACGT\n")
+        files.append(str(path))
+    store = str(tmp_path / "store")
+    seqs = np.frombuffer(b"AAAACCCCAAAAGGGG", dtype=np.uint8).reshape(4, 4)
+    # every row claims the same digest: only identical bytes may share a row
+    index = update_store(store, new_index(), files[:3], ["a", "b", "c"], seqs[:3], [None] * 3, ["x"] * 3)
+    assert [index['files'][f]['row'] for f in files[:3]] == [0, 1, 0]
+    index = update_store(store, index, files[3:], ["d"], seqs[3:], [None], ["x"])
+    assert index['files'][files[3]]['row'] == 2
+    assert open_rows(store, index).tobytes() == b"AAAACCCCGGGG"
+
+def _vcf_per_site(array, names):
+    """The original per-site writer, kept as the reference for the columnar one."""
+    letters = decode_bases(array)
+    lines = ["##fileformat=VCFv4.1", f"##contig=<ID=1,length={array.shape[1]}>",
+             '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+             "\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"] + names)]
+    for pos in range(array.shape[1]):
+        site = letters[:, pos]
+        alts = sorted(set(site) - {site[0], "0"})
+        allele_map = {site[0]: "0", **{a: str(i) for i, a in enumerate(alts, start=1)}}
+        lines.append("\t".join(["1", str(pos + 1), ".", site[0], ",".join(alts) or ".", ".", ".", ".", "GT"]
+                               + [allele_map[x] for x in site]))
+    return "\n".join(lines) + "\n"
+
+def test_write_vcf_matches_per_site_writer(tmp_path):
+    rng = np.random.default_rng(1)
+    array = rng.choice([1, 2, 4, 8], size=(40, 300)).astype(np.uint8)
+    array[:, :50] = rng.integers(0, 16, size=(40, 50))    # many ALTs, including N and >9 alleles
+    array[:, 50:60] = array[0, 50:60]                     # monomorphic sites
+    names = [f"s{i}" for i in range(40)]
+    out = tmp_path / "core.vcf"
+    write_vcf_from_array(array, names, str(out))
+    assert out.read_text() == _vcf_per_site(array, names)
+
+def test_write_vcf_bgzf_with_index(tmp_path):
+    array = np.random.default_rng(2).choice([1, 2, 4, 8, 0], size=(20, 40000)).astype(np.uint8)
+    names = [f"s{i}" for i in range(20)]
+    write_vcf_from_array(array, names, str(tmp_path / "core.vcf"))
+    out = tmp_path / "core.vcf.gz"
+    write_vcf_from_array(array, names, str(out), compress=True, index="tbi", threads=2)
+    data = out.read_bytes()
+    assert gzip.decompress(data) == (tmp_path / "core.vcf").read_bytes()
+    # BGZF: every member carries a BC extra field and the file ends with the empty EOF block
+    assert data[12:16] == b"BC\x02\x00" and data.endswith(bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000"))
+    index = gzip.decompress((tmp_path / "core.vcf.gz.tbi").read_bytes())
+    assert index[:4] == b"TBI\x01"
+
+def test_write_distances_binary_formats(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    diffs = np.array([[0, 3, 300], [3, 0, 7], [300, 7, 0]], dtype=np.int64)
+    write_distances(["a", "b", "c"], diffs, ["npy", "triu"])
+    assert not (tmp_path / "dist_wide.csv").exists() and not (tmp_path / "dist_long.csv").exists()
+    assert (tmp_path / "dist_names.txt").read_text() == "a\nb\nc\n"
+    matrix = np.load(tmp_path / "dist_matrix.npy", mmap_mode="r")
+    assert matrix.dtype == np.uint16 and np.array_equal(matrix, diffs)
+    assert np.load(tmp_path / "dist_triu.npy").tolist() == [3, 300, 7]
+
+def test_write_distances_csv_blocks_match_cellwise(tmp_path, monkeypatch):
+    from polycore.io_ops import _wide_lines, _wide_lines_cellwise, _long_lines_cellwise
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(3)
+    diffs = rng.integers(0, 12000, size=(57, 57))
+    diffs[:, 5] = 0
+    names = [f"sample_{i}" * (i % 3 + 1) for i in range(57)]
+    write_distances(names, diffs)
+    wide = b"name," + ",".join(names).encode() + b"\n" + b"".join(_wide_lines_cellwise(names, diffs))
+    long = b"sample1,sample2,diff\n" + b"".join(_long_lines_cellwise(names, diffs))
+    assert (tmp_path / "dist_wide.csv").read_bytes() == wide
+    assert (tmp_path / "dist_long.csv").read_bytes() == long
+    assert b"".join(_wide_lines(names, diffs, block_cells=100)) == wide.split(b"\n", 1)[1]
+
+def test_writers_stream_from_expanded_view(tmp_path, monkeypatch):
+    from polycore.collapse import ExpandedView, expand_results
+    from polycore.io_ops import write_fasta_from_array, write_vcf_from_array, write_summary
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(5)
+    reps = rng.choice(np.array([0, 1, 2, 4, 8, 5], dtype=np.uint8), size=(3, 40))
+    idx_map = {0: [0, 3], 1: [1], 2: [2, 4, 5]}
+    names = [f"s{i}" for i in range(6)]
+    mask = np.array([True, True, True])
+    view = ExpandedView(reps, mask, idx_map, keep_filtered=False)
+    dense, dense_names = expand_results(reps, mask, idx_map, names, keep_filtered=False)
+    assert view.shape == dense.shape and view.names(names) == dense_names
+
+    gf, cf, var = np.full(6, 0.5), np.full(6, 1.0), np.arange(6)
+    for data, suffix in ((view, "view"), (dense, "dense")):
+        write_fasta_from_array(data, dense_names, f"{suffix}.aln")
+        write_vcf_from_array(data, dense_names, f"{suffix}.vcf")
+        write_summary(dense_names, data, gf, cf, var)
+        (tmp_path / "summary.csv").rename(tmp_path / f"{suffix}.csv")
+    for ext in ("aln", "vcf", "csv"):
+        assert (tmp_path / f"view.{ext}").read_bytes() == (tmp_path / f"dense.{ext}").read_bytes()
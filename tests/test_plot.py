@@ -0,0 +1,21 @@
+import sys
+import numpy as np
+from polycore.plot import create_plot, plot_points
+
+def test_svg_plot_size_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    n = 20000
+    cfs = list(np.linspace(1.0, 0.6, n))
+    names = [f"sample_<{i}>" for i in range(n)]
+    assert create_plot(cfs, names, "svg")
+    page = (tmp_path / "core_fraction_plot.html").read_text()
+    assert "<svg" in page and "sample_&lt;0&gt;" in page
+    assert page.count("<circle") <= 1000 and len(page) < 400_000
+    assert "plotly" not in sys.modules
+
+def test_plot_points_keeps_extremes():
+    values = np.sin(np.linspace(0, 20, 5000))
+    keep = plot_points(values, max_points=100)
+    assert len(keep) <= 100
+    assert values.argmin() in keep and values.argmax() in keep
+    assert plot_points(values[:50]).tolist() == list(range(50))
@@ -0,0 +1,20 @@
+import json
+import numpy as np
+from polycore.profiling import StageReport
+
+def test_stage_report_records_arrays_and_json(tmp_path):
+    report = StageReport()
+    with report.stage("alloc") as arrays:
+        data = np.ones((100, 50), dtype=np.uint16)
+        arrays["data"] = data
+    assert arrays == {}  # nothing kept alive by the report
+    with report.stage("empty"):
+        pass
+    first = report.stages[0]
+    assert first["stage"] == "alloc" and first["wall_s"] >= 0 and first["cpu_s"] >= 0
+    assert first["arrays"] == {"data": {"shape": [100, 50], "dtype": "uint16", "mb": data.nbytes / (1 << 20)}}
+    report.log_table()
+    report.write_json(str(tmp_path / "timings.json"), version="test")
+    saved = json.loads((tmp_path / "timings.json").read_text())
+    assert saved["version"] == "test" and [s["stage"] for s in saved["stages"]] == ["alloc", "empty"]
+    assert saved["total"]["peak_rss_mb"] > 0
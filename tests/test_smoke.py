@@ -4,3 +4,16 @@ import subprocess, sys
 def test_cli_help():
     r = subprocess.run([sys.executable, "-m", "polycore", "--version"], capture_output=True)
     assert r.returncode == 0
+
+def test_import_time():
+    """polycore's own import cost (without numpy) stays small and loads no optional libraries."""
+    code = "import sys, polycore.cli; print(','.join(m for m in ('plotly', 'psutil') if m in sys.modules))"
+    r = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    assert r.returncode == 0 and r.stdout.strip() == ""
+    cumulative = {}
+    for line in r.stderr.splitlines()[1:]:
+        _, total, name = line.split("|")
+        cumulative[name.strip()] = int(total) / 1e6
+    own = cumulative["polycore.cli"] - cumulative.get("numpy", 0)
+    print(f"import polycore.cli: {cumulative['polycore.cli']:.3f} s ({own:.3f} s excluding numpy)")
+    assert own < 1.0
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from polycore.cli import main
+
+OUTPUTS = ["core.aln", "core.full.aln", "core.vcf", "dist_wide.csv", "dist_long.csv", "summary.csv", "fconst.txt"]
+
+def _write_samples(tmp_path):
+    rng = np.random.default_rng(3)
+    ref = rng.choice(list("ACGT"), 300)
+    files = []
+    for i in range(6):
+        seq = ref.copy()
+        if i != 3:  # sample 3 duplicates the reference
+            seq[rng.random(300) < 0.05] = rng.choice(list("ACGTRYN"), 1)[0]
+        seq[rng.integers(0, 280):][:rng.integers(0, 20)] = "N"
+        path = tmp_path / f"s{i}.fa"
+        path.write_text(f">s{i}\n" + "".join(seq) + "\n")
+        files.append(str(path))
+    ref_path = tmp_path / "ref.fa"
+    ref_path.write_text(">ref\n" + "".join(ref) + "\n")
+    return str(ref_path), files
+
+@pytest.mark.parametrize("extra", [[], ["--progressive"]])
+def test_stream_matches_in_memory(tmp_path, monkeypatch, extra):
+    ref, samples = _write_samples(tmp_path)
+    argv = ["--ref", ref, "--sample", *samples, "--min-gf", "0.5", "--min-cf", "0.9"] + extra
+    outputs = {}
+    for mode, flags in [("memory", []), ("stream", ["--stream", "--window-size", "37"])]:
+        out = tmp_path / mode
+        out.mkdir()
+        monkeypatch.chdir(out)
+        main(argv + flags)
+        outputs[mode] = {name: (out / name).read_bytes() for name in OUTPUTS}
+    assert outputs["stream"] == outputs["memory"]
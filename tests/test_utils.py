@@ -0,0 +1,43 @@
+from polycore.utils import cgroup_memory_available
+
+def test_cgroup_memory_available_v2_and_v1(tmp_path):
+    v2 = tmp_path / "v2"
+    v2.mkdir()
+    (v2 / "memory.max").write_text("1073741824\n")
+    (v2 / "memory.current").write_text("536870912\n")
+    (v2 / "memory.stat").write_text("anon 1\ninactive_file 268435456\n")
+    assert cgroup_memory_available(str(v2)) == 1073741824 - (536870912 - 268435456)
+    (v2 / "memory.max").write_text("max\n")
+    assert cgroup_memory_available(str(v2)) is None
+
+    v1 = tmp_path / "v1" / "memory"
+    v1.mkdir(parents=True)
+    (v1 / "memory.limit_in_bytes").write_text("2147483648\n")
+    (v1 / "memory.usage_in_bytes").write_text("1073741824\n")
+    assert cgroup_memory_available(str(tmp_path / "v1")) == 1073741824
+    assert cgroup_memory_available(str(tmp_path / "none")) is None
+
+def test_cgroup_memory_available_nested(tmp_path):
+    def cgroup(directory, limit, usage):
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / "memory.max").write_text(f"{limit}\n")
+        (directory / "memory.current").write_text(f"{usage}\n")
+    root = tmp_path / "cgroup"
+    cgroup(root / "kubepods.slice", 8 << 30, 1 << 30)
+    cgroup(root / "kubepods.slice" / "pod1", 2 << 30, 1 << 30)
+    cgroup(root / "kubepods.slice" / "pod1" / "app", "max", 1 << 30)
+    proc = tmp_path / "proc_cgroup"
+    proc.write_text("0::/kubepods.slice/pod1/app\n")
+    # the pod limit two levels up is the tightest
+    assert cgroup_memory_available(str(root), str(proc)) == 1 << 30
+    # v1: the memory controller line names the cgroup
+    v1 = tmp_path / "v1"
+    for path, limit in ((v1 / "memory", 1 << 62), (v1 / "memory" / "docker" / "c1", 3 << 30)):
+        path.mkdir(parents=True)
+        (path / "memory.limit_in_bytes").write_text(f"{limit}\n")
+        (path / "memory.usage_in_bytes").write_text(f"{1 << 30}\n")
+    proc.write_text("12:cpu,cpuacct:/docker/c1\n4:memory:/docker/c1\n")
+    assert cgroup_memory_available(str(v1), str(proc)) == 2 << 30
+    # a namespaced view: the listed path does not exist under the mount, which is our cgroup
+    proc.write_text("0::/elsewhere\n")
+    assert cgroup_memory_available(str(root / "kubepods.slice" / "pod1"), str(proc)) == 1 << 30